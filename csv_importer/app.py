@@ -10,11 +10,13 @@ import sys
 import os
 import argparse
 
-from csv_importer.import_csv import import_file, SUPPORTED_IMPORT_CSV_TYPES
-from csv_importer.runtime import enable_verbose_logging, enable_dry_run
+from csv_importer.import_csv import import_file, import_batch, SUPPORTED_IMPORT_CSV_TYPES, SUPPORTED_LOAD_MODES
+from csv_importer.runtime import enable_verbose_logging, enable_dry_run, enable_profiling, profiled
 from csv_importer.db_manage import list_examinations, delete_examination, init_db
 from csv_importer.db import DEFAULT_DB_URL
+from csv_importer.query_stats import log_query_stats
 from csv_importer.wikidata import import_from_wikidata, SUPPORTED_IMPORT_WIKIDATA_TYPES
+from csv_importer.wikidata_cache import get_wikidata_cache
 
 
 _cli_help=\
@@ -23,6 +25,9 @@ CLI application for importing DZI or NVO CSV data.
 
 The target DB is defined via DB_URL environment variable.
 Its default value is: {DEFAULT_DB_URL}
+
+Set DB_QUERY_STATS=yes to print summary of the executed SQL statements
+at the end of the command.
 '''
 
 def parse_args():
@@ -39,13 +44,37 @@ def parse_args():
     default_wikidata_to_import = SUPPORTED_IMPORT_WIKIDATA_TYPES
     help_wikidata_to_import = f'Specifies what data to be imported from the CSV. By default imports {default_wikidata_to_import}.'
 
+    help_load_mode = (
+        'Specifies how the scores are written into the DB. '
+        '`copy` is the fastest way to (re-)load whole examination. By default uses `upsert`.'
+    )
+
+    help_chunk_size = (
+        'When specified, the CSV file is read and imported in chunks of that many rows, '
+        'so the memory usage does not depend on the size of the file.'
+    )
+
+    help_metrics_file = 'Path to file where the timing and memory report of the import is appended as JSON line.'
+
+    help_force = 'Import the CSV even if the same file was already imported for the examination.'
+
+    help_plan_file = 'Used with --dry-run, path to CSV file where all changes of the examination scores are written.'
+
+    help_profile = 'Profile the command, the results are written in PROFILE_DIR or in `profiles` next to the log files.'
+
     # Subparser for import-dzi
     parser_dzi = subparsers.add_parser('import-dzi', help='Import DZI data')
     parser_dzi.add_argument('--csv', type=str, required=True, help='Path to the CSV file')
     parser_dzi.add_argument('--year', type=int, required=True, help='Year')
     parser_dzi.add_argument('--to-import', type=str, nargs='*', default=default_csv_to_import, help=help_csv_to_import)
+    parser_dzi.add_argument('--load-mode', type=str, choices=SUPPORTED_LOAD_MODES, default='upsert', help=help_load_mode)
+    parser_dzi.add_argument('--force', action='store_true', help=help_force)
+    parser_dzi.add_argument('--metrics-file', type=str, default=None, help=help_metrics_file)
+    parser_dzi.add_argument('--plan-file', type=str, default=None, help=help_plan_file)
+    parser_dzi.add_argument('--chunk-size', type=int, default=None, help=help_chunk_size)
     parser_dzi.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_dzi.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_dzi.add_argument('--profile', action='store_true', help=help_profile)
 
     # Subparser for import-nvo
     parser_nvo = subparsers.add_parser('import-nvo', help='Import NVO data')
@@ -53,31 +82,72 @@ def parse_args():
     parser_nvo.add_argument('--year', type=int, required=True, help='Year')
     parser_nvo.add_argument('--grade', type=int, required=True, help='Grade')
     parser_nvo.add_argument('--to-import', type=str, nargs='*', default=default_csv_to_import, help=help_csv_to_import)
+    parser_nvo.add_argument('--load-mode', type=str, choices=SUPPORTED_LOAD_MODES, default='upsert', help=help_load_mode)
+    parser_nvo.add_argument('--force', action='store_true', help=help_force)
+    parser_nvo.add_argument('--metrics-file', type=str, default=None, help=help_metrics_file)
+    parser_nvo.add_argument('--plan-file', type=str, default=None, help=help_plan_file)
+    parser_nvo.add_argument('--chunk-size', type=int, default=None, help=help_chunk_size)
     parser_nvo.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_nvo.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_nvo.add_argument('--profile', action='store_true', help=help_profile)
+
+    # Subparser for import-batch
+    help_manifest = (
+        'Path to a CSV file without header listing the files to import. Each line has the columns '
+        'name,year,grade,path where the name starts with the examination type, e.g. nvo-4-2019.'
+    )
+    parser_batch = subparsers.add_parser('import-batch', help='Import multiple DZI and NVO CSV files listed in a manifest')
+    parser_batch.add_argument('--manifest', type=str, required=True, help=help_manifest)
+    parser_batch.add_argument('--to-import', type=str, nargs='*', default=default_csv_to_import, help=help_csv_to_import)
+    parser_batch.add_argument('--load-mode', type=str, choices=SUPPORTED_LOAD_MODES, default='upsert', help=help_load_mode)
+    parser_batch.add_argument('--force', action='store_true', help=help_force)
+    parser_batch.add_argument('--metrics-file', type=str, default=None, help=help_metrics_file)
+    parser_batch.add_argument('--workers', type=int, default=None, help='Number of processes refining the CSV files. By default one per CPU.')
+    parser_batch.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser_batch.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_batch.add_argument('--profile', action='store_true', help=help_profile)
 
     # Subparser for init db steps
     parser_init_db = subparsers.add_parser('init-db', help='This command puts initial data in tables like Subject')
     parser_init_db.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_init_db.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_init_db.add_argument('--profile', action='store_true', help=help_profile)
 
     # Subparser for list-examinations
     parser_list_exam = subparsers.add_parser('list-examinations', help='List records from table examinations')
     parser_list_exam.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_list_exam.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_list_exam.add_argument('--profile', action='store_true', help=help_profile)
 
     # Subparser for delete-examination
     parser_del_exam = subparsers.add_parser('delete-examination', help='Delete everything related to the specified examination')
     parser_del_exam.add_argument('--id', type=str, required=True, help='ID of the examination to be delete')
     parser_del_exam.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_del_exam.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_del_exam.add_argument('--profile', action='store_true', help=help_profile)
 
     # Subparser for extracting data from wikidata
     parser_import_from_wikidata = subparsers.add_parser('import-from-wikidata', help='Imports data from wikidata')
     # parser_extract_wiki_data.add_argument('--id', type=str, required=True, help='ID of the examination to be delete')
     parser_import_from_wikidata.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser_import_from_wikidata.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_import_from_wikidata.add_argument('--profile', action='store_true', help=help_profile)
     parser_import_from_wikidata.add_argument('--to-import', type=str, nargs='*', default=default_wikidata_to_import, help=help_wikidata_to_import)
+    parser_import_from_wikidata.add_argument('--offline', action='store_true', help='Use only the cached results of the wikidata queries, never the network.')
+    parser_import_from_wikidata.add_argument('--incremental', action='store_true', help='Import only the entities modified in wikidata after the previous import.')
+
+    # Subparsers for moving the wikidata cache between machines
+    parser_export_cache = subparsers.add_parser('export-wikidata-cache', help='Writes all cached wikidata results in a bundle file')
+    parser_export_cache.add_argument('--bundle', type=str, required=True, help='Path to the bundle file')
+    parser_export_cache.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser_export_cache.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_export_cache.add_argument('--profile', action='store_true', help=help_profile)
+
+    parser_import_cache = subparsers.add_parser('import-wikidata-cache', help='Adds the wikidata results from a bundle file to the cache')
+    parser_import_cache.add_argument('--bundle', type=str, required=True, help='Path to the bundle file written by export-wikidata-cache')
+    parser_import_cache.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser_import_cache.add_argument('-n', '--dry-run', action='store_true', help='Perform a dry run without making changes')
+    parser_import_cache.add_argument('--profile', action='store_true', help=help_profile)
 
 
     args = parser.parse_args()
@@ -93,21 +163,13 @@ def parse_args():
     return args
 
 
-def main():
-
-    args = parse_args()
-    print(f'args: {args}', file=sys.stderr)
-
-    if args.verbose:
-        enable_verbose_logging()
-
-    if args.dry_run:
-        enable_dry_run()
-
+def run_command(args):
     if args.command == 'import-dzi':
-        import_file(args.csv, 'dzi', 12, args.year, args.to_import)
+        import_file(args.csv, 'dzi', 12, args.year, args.to_import, args.load_mode, chunk_size=args.chunk_size, force=args.force, metrics_file=args.metrics_file, plan_file=args.plan_file)
     elif args.command == 'import-nvo':
-        import_file(args.csv, 'nvo', args.grade, args.year, args.to_import)
+        import_file(args.csv, 'nvo', args.grade, args.year, args.to_import, args.load_mode, chunk_size=args.chunk_size, force=args.force, metrics_file=args.metrics_file, plan_file=args.plan_file)
+    elif args.command == 'import-batch':
+        import_batch(args.manifest, args.to_import, args.load_mode, args.workers, args.force, args.metrics_file)
     elif args.command == 'init-db':
         init_db()
     elif args.command == 'list-examinations':
@@ -115,10 +177,35 @@ def main():
     elif args.command == 'delete-examination':
         delete_examination(args.id)
     elif args.command == 'import-from-wikidata':
-        import_from_wikidata(args.to_import)
+        import_from_wikidata(args.to_import, args.offline, args.incremental)
+    elif args.command == 'export-wikidata-cache':
+        get_wikidata_cache().export_bundle(args.bundle)
+    elif args.command == 'import-wikidata-cache':
+        get_wikidata_cache().import_bundle(args.bundle)
     else:
         raise RuntimeError(f'Unsupported command: {args.command}')
 
+
+def main():
+
+    args = parse_args()
+    print(f'args: {args}', file=sys.stderr)
+
+    if args.verbose:
+        enable_verbose_logging()
+
+    if args.dry_run:
+        enable_dry_run()
+
+    if args.profile:
+        enable_profiling()
+
+    try:
+        with profiled(args.command):
+            run_command(args)
+    finally:
+        log_query_stats()
+
 if __name__ == '__main__':
     log_level = logging.DEBUG if os.environ.get('DEBUG', 'no') == 'yes' else logging.INFO
     logging.basicConfig(level=log_level)
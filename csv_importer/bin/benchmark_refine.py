@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the refine stages in csv_importer/refine_csv.py:
+load_csv, refine_csv_column_names, refine_data and extract_scores_data.
+
+The file is refined as by the importer, with open_csv() which reads and
+cleans the lines lazily while the next stages read them. The time spent
+in reading the lines is measured as load_csv and subtracted from the
+stages which read them. The sum of the first three stages is reported as
+refine_total.
+
+The benchmark runs over the synthetic CSV files from
+generate_synthetic_csv.py, they are generated when missing. After each run
+the results of extract_school_data() and extract_scores_data() are compared
+with the expected results written by the generator, so an optimization
+which changes the results is reported as failure.
+
+The database is not used, the subjects are the ones from get_default_subjects().
+
+Usage:
+    ./bin/benchmark_refine.py [--scale 1 10] [--variants ...] [--repeat 3] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import pandas as pd
+
+from generate_synthetic_csv import BENCHMARK_DIR, VARIANTS, generate
+
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
+from csv_importer.models import get_default_subjects
+from csv_importer.refine_csv import (
+    LinesReader, open_csv, refine_csv_column_names, refine_data,
+    extract_school_data, extract_scores_data
+)
+
+
+STAGES = ['load_csv', 'refine_csv_column_names', 'refine_data', 'extract_scores_data', 'refine_total']
+
+
+def get_subject_mapping() -> dict:
+    mapping = {}
+    for item in get_default_subjects():
+        for raw_str in item.raw_strings():
+            mapping[raw_str] = item
+
+    return mapping
+
+
+class TimedLines:
+    """
+    Iterator over the lines of LinesReader which measures the time spent
+    in reading them.
+    """
+
+    def __init__(self, lines: LinesReader):
+        self.lines = lines
+        self.duration = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        started = time.perf_counter()
+        try:
+            return next(self.lines)
+        finally:
+            self.duration += time.perf_counter() - started
+
+
+def run_once(csv_file: str, subject_mapping: dict) -> tuple[dict[str, float], pd.DataFrame, pd.DataFrame]:
+    """
+    Runs all stages once, returns the duration of each stage and the
+    extracted schools and scores.
+    """
+    durations = {}
+
+    started = time.perf_counter()
+    with open_csv(csv_file) as raw_data:
+        lines = TimedLines(raw_data)
+        opened = time.perf_counter() - started
+
+        started = time.perf_counter()
+        raw_data = refine_csv_column_names(lines)
+        header_load = lines.duration
+        durations['refine_csv_column_names'] = time.perf_counter() - started - header_load
+
+        started = time.perf_counter()
+        refined_data = refine_data(raw_data, subject_mapping)
+        durations['refine_data'] = time.perf_counter() - started - (lines.duration - header_load)
+
+    durations['load_csv'] = opened + lines.duration
+    durations['refine_total'] = durations['load_csv'] + durations['refine_csv_column_names'] + durations['refine_data']
+
+    schools = extract_school_data(refined_data)
+
+    started = time.perf_counter()
+    scores = extract_scores_data(refined_data)
+    durations['extract_scores_data'] = time.perf_counter() - started
+
+    return durations, schools, scores
+
+
+def check_results(variant: str, csv_file: str, schools: pd.DataFrame, scores: pd.DataFrame) -> list[str]:
+    """
+    Compares the results with the expected ones, returns list of errors.
+    """
+    base_path = csv_file[:-len('.csv')]
+    errors = []
+
+    expected_schools = pd.read_csv(f'{base_path}.schools.csv', dtype=str, keep_default_na=False)
+    actual_schools = schools.astype(str).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(actual_schools, expected_schools, check_dtype=False)
+    except AssertionError as e:
+        errors.append(f'schools: {e}')
+
+    expected_max_score = 6.0 if variant.startswith('dzi') else 100.0
+    if not (scores['max_possible_score'] == expected_max_score).all():
+        errors.append(f'max_possible_score: expected {expected_max_score}, got {scores["max_possible_score"].unique()}')
+
+    sort_by = ['school_admin_id', 'subject']
+    expected_scores = pd.read_csv(f'{base_path}.scores.csv', dtype={'school_admin_id': str})
+    expected_scores = expected_scores.sort_values(sort_by).reset_index(drop=True)
+    actual_scores = scores.loc[:, expected_scores.columns].sort_values(sort_by).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(actual_scores, expected_scores, check_dtype=False)
+    except AssertionError as e:
+        errors.append(f'scores: {e}')
+
+    return errors
+
+
+def benchmark(variant: str, scale: float, repeat: int, output_dir: str, subject_mapping: dict) -> dict:
+    csv_file = os.path.join(output_dir, f'{variant}-x{scale:g}.csv')
+    if not os.path.exists(csv_file):
+        generate(variant, scale, output_dir)
+
+    runs = []
+    for _ in range(repeat):
+        durations, schools, scores = run_once(csv_file, subject_mapping)
+        runs.append(durations)
+
+    errors = check_results(variant, csv_file, schools, scores)
+    rows = len(schools)
+
+    result = {'variant': variant, 'scale': scale, 'rows': rows, 'errors': errors, 'stages': {}}
+    for stage in STAGES:
+        stage_durations = [r[stage] for r in runs]
+        best = min(stage_durations)
+        result['stages'][stage] = {
+            'best': best,
+            'median': statistics.median(stage_durations),
+            'rows_per_second': rows / best if best else None,
+        }
+
+    return result
+
+
+def print_result(result: dict):
+    status = 'OK' if not result['errors'] else 'FAILED'
+    print(f"{result['variant']} x{result['scale']:g} ({result['rows']} rows): {status}")
+    for stage, stats in result['stages'].items():
+        print(f"  {stage:<25} best {stats['best']:9.4f}s  median {stats['median']:9.4f}s  {stats['rows_per_second'] or 0:12.0f} rows/s")
+    for error in result['errors']:
+        print(f'  {error}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the refine stages over synthetic CSV files.')
+    parser.add_argument('--scale', type=float, nargs='*', default=[1], help='Scale factors of the synthetic files. By default 1.')
+    parser.add_argument('--variants', type=str, nargs='*', choices=list(VARIANTS), default=list(VARIANTS), help='By default all variants.')
+    parser.add_argument('--repeat', type=int, default=3, help='How many times each file is refined. By default 3.')
+    parser.add_argument('--output-dir', type=str, default=BENCHMARK_DIR, help=f'Directory with the synthetic files. By default {BENCHMARK_DIR}')
+    parser.add_argument('--json', type=str, help='Path to file where the results are written as JSON.')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    subject_mapping = get_subject_mapping()
+
+    results = []
+    for scale in args.scale:
+        for variant in args.variants:
+            result = benchmark(variant, scale, args.repeat, args.output_dir, subject_mapping)
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+    if any(r['errors'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
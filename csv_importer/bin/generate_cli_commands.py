@@ -11,6 +11,7 @@ import json
 import argparse
 import os
 import re
+import sys
 
 
 DAGS = {
@@ -49,7 +50,7 @@ def get_airflow_trigger_command(examination_type: str, year: int, grade: int, re
     return f"airflow dags trigger {dag_id} --conf '{params_str}'"
 
 
-def get_app_py_command(filepath: str, examination_type: str, year: int, grade: int, dry_run: bool, verbose: bool) -> str:
+def get_app_py_command(filepath: str, examination_type: str, year: int, grade: int, dry_run: bool, verbose: bool, load_mode: str) -> str:
     if examination_type == 'dzi':
         import_cmd = 'import-dzi'
         grade_param = ''
@@ -60,8 +61,9 @@ def get_app_py_command(filepath: str, examination_type: str, year: int, grade: i
 
     dry_run_param = '' if not dry_run else ' -n'
     verbose_param = '' if not verbose else ' -v'
+    load_mode_param = '' if not load_mode else f' --load-mode {load_mode}'
 
-    return f'./app.py {import_cmd} --csv {filepath} --year {year}{grade_param}{dry_run_param}{verbose_param}'
+    return f'./app.py {import_cmd} --csv {filepath} --year {year}{grade_param}{dry_run_param}{verbose_param}{load_mode_param}'
 
 
 TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
@@ -103,6 +105,13 @@ def parse_args():
     app_py.add_argument('--verbose-value', type=str2bool,
                         help=('Value for the verbose argument. '
                               f'Possible values are: {TRUE_VALUES}\n{FALSE_VALUES}'))
+    app_py.add_argument('--load-mode-value', type=str, choices=['upsert', 'copy'],
+                        help=('Value for the --load-mode argument. Use `copy` when '
+                              'whole examinations are re-imported.'))
+
+
+    manifest = subparsers.add_parser('manifest', help='Generates manifest for `app.py import-batch`')
+    manifest.add_argument('--local-csv-dir', type=str, help='Path to the directory containing CSV files')
 
 
     return parser.parse_args()
@@ -124,28 +133,45 @@ def generate_for_airflow(args):
             print(get_airflow_trigger_command(examination_type, int(year), int(grade), resource_id, args.dry_run_value))
 
 
-def generate_for_app_py(args):
+def iter_local_csv_files(local_csv_dir: str):
+    """
+    Yields (filepath, examination_type, year, grade) for the CSV files
+    downloaded with download_csv.py.
+    """
     dzi_re = 'dzi-([0-9]{4})-.*.csv'
     nvo_re = 'nvo-([0-9]+)-([0-9]{4})-.*.csv'
-    for item in os.listdir(args.local_csv_dir):
-        filepath = os.path.join(args.local_csv_dir, item)
+    for item in sorted(os.listdir(local_csv_dir)):
+        filepath = os.path.join(local_csv_dir, item)
 
         dzi_m = re.match(dzi_re, item)
         if dzi_m:
-            print(get_app_py_command(filepath, 'dzi', dzi_m.group(1), 12, args.dry_run_value, args.verbose_value))
+            yield filepath, 'dzi', dzi_m.group(1), 12
         else:
             nvo_m = re.match(nvo_re, item)
             if nvo_m:
-                print(get_app_py_command(filepath, 'nvo', nvo_m.group(2), nvo_m.group(1), args.dry_run_value, args.verbose_value))
+                yield filepath, 'nvo', nvo_m.group(2), nvo_m.group(1)
+
+
+def generate_for_app_py(args):
+    for filepath, examination_type, year, grade in iter_local_csv_files(args.local_csv_dir):
+        print(get_app_py_command(filepath, examination_type, year, grade, args.dry_run_value, args.verbose_value, args.load_mode_value))
+
+
+def generate_manifest(args):
+    for filepath, examination_type, year, grade in iter_local_csv_files(args.local_csv_dir):
+        name = f'{examination_type}-{year}' if examination_type == 'dzi' else f'{examination_type}-{grade}-{year}'
+        print(f'{name},{year},{grade},{os.path.abspath(filepath)}')
 
 
 
 def main():
     args = parse_args()
-    print(f'args: {args}')
+    print(f'args: {args}', file=sys.stderr)
 
     if args.command == 'airflow':
         generate_for_airflow(args)
+    elif args.command == 'manifest':
+        generate_manifest(args)
     else:
         generate_for_app_py(args)
 
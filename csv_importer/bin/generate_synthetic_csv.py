@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Generates synthetic NVO and DZI CSV files in all header variants documented
+in csv_importer/refine_csv.py. The files are used by benchmark_refine.py.
+
+For each variant are generated:
+* <variant>-x<scale>.csv - the CSV file, with BOM and NBSP noise in the
+  header, spaces in some school ids, missing municipalities, missing scores
+  and decimal commas (for DZI), the same as the real files.
+* <variant>-x<scale>.schools.csv and <variant>-x<scale>.scores.csv - the
+  expected results of extract_school_data() and extract_scores_data().
+  They are built from the generated values, not by refine_csv.py.
+
+The scale is the number of rows divided by BASE_ROWS, which is about the
+number of schools in one real file. The rows are written one by one, so
+even the 1000x files do not need much memory.
+
+Usage:
+    ./bin/generate_synthetic_csv.py [--scale 1 10 100] [--variants nvo-4-2019 ...] [--output-dir DIR]
+"""
+
+import argparse
+import csv
+import os
+import random
+
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+CSV_IMPORTER_DIR = os.path.dirname(SCRIPT_DIR)
+BENCHMARK_DIR = os.environ.get('BENCHMARK_DIR', os.path.join(CSV_IMPORTER_DIR, 'work', 'benchmark'))
+
+BASE_ROWS = 2000
+
+BOM = '\ufeff'
+NBSP = '\xa0'
+
+# (region, municipality, places) as found in the CSV files and the same
+# values as expected after refine_data().
+PLACES = [
+    (('София-град', 'Столична', ['гр.София', 'гр. Банкя']),
+     ('София-Град', 'Столична', ['гр. София', 'гр. Банкя'])),
+    (('Пловдив', 'Пловдив', ['гр.Пловдив']),
+     ('Пловдив', 'Пловдив', ['гр. Пловдив'])),
+    (('Добрич', 'гр.Добрич', ['гр.Добрич']),
+     ('Добрич', 'Гр.Добрич', ['гр. Добрич'])),
+    (('Добрич', 'Добрич', ['с.Карапелит', 'с. Победа']),
+     ('Добрич', 'Добрич', ['с. Карапелит', 'с. Победа'])),
+    (('ЧУЖБИНА', 'Чужбина', ['Лондон']),
+     ('Чужбина', 'Чужбина', ['Лондон'])),
+]
+
+# For each variant the subjects as found in the CSV header and the
+# Subject ids expected after refine_data(). None means the subject is
+# removed by refine_data().
+VARIANTS = {
+    'nvo-4-2019': [('МАТ', 'МАТ'), ('БЕЛ', 'БЕЛ'), ('ЧО', 'ЧО'), ('ЧП', 'ЧП')],
+    'nvo-4-2023': [('БЕЛ', 'БЕЛ'), ('МАТ', 'МАТ')],
+    'nvo-7-2021': [('БЕЛ', 'БЕЛ'), ('МАТ', 'МАТ')],
+    'dzi-2023': [
+        ('БЕЛ(ООП)', 'БЕЛ'), ('Мат(ПП)', 'МАТ'), ('Ист(ПП)', 'ИСТ'),
+        ('АЕ B1-З', 'АЕ-Б1'), ('ФЕ B2-З', 'ФРЕ-Б2'), ('Общо', None)
+    ],
+}
+
+
+def _header_lines(variant: str) -> list[list[str]]:
+    subjects = [raw for raw, _ in VARIANTS[variant]]
+
+    if variant == 'nvo-4-2019':
+        # the people and score columns are not paired by subject
+        return [
+            ['Област', 'Община', 'Населено място', 'Код', 'Училище']
+            + [f'Явили се {s}' for s in subjects]
+            + [f'Ср. успех в точки {s}' for s in subjects]
+        ]
+    elif variant == 'nvo-4-2023':
+        # a title line and two lines header
+        return [
+            ['Резултати от НВО'],
+            ['Област', 'Община', 'Населено място', 'Училище', 'Код по Админ'] + sum([[s, ''] for s in subjects], []),
+            [''] * 5 + ['Явили се', 'Ср. успех в точки'] * len(subjects),
+        ]
+    elif variant == 'nvo-7-2021':
+        # the second line contains the subjects as options
+        return [
+            ['Област', 'Община', 'Населено място', 'Училище', 'Код по Админ'] + ['Явили се', 'Ср. успех в точки'] * len(subjects),
+            [''] * 5 + sum([[s, s] for s in subjects], []),
+        ]
+    else:
+        # three lines header
+        return [
+            ['Област', 'Община', 'Населено място', 'Училище', 'Код по Админ'] + sum([[s, ''] for s in subjects], []),
+            [''] * 5 + ['З', ''] * len(subjects),
+            [''] * 5 + ['Бр.', 'Ср.усп.'] * len(subjects),
+        ]
+
+
+def _school_columns_order(variant: str) -> list[str]:
+    if variant == 'nvo-4-2019':
+        return ['region', 'municipality', 'place', 'school_admin_id', 'school']
+    return ['region', 'municipality', 'place', 'school', 'school_admin_id']
+
+
+def generate(variant: str, scale: float, output_dir: str, seed: int = 1) -> str:
+    """
+    Generates the CSV file and the expected results for the variant,
+    returns the path to the CSV file.
+    """
+    rng = random.Random(seed)
+    rows_count = max(1, int(BASE_ROWS * scale))
+    subjects = VARIANTS[variant]
+    is_dzi = variant.startswith('dzi')
+    paired = variant != 'nvo-4-2019'
+
+    base_path = os.path.join(output_dir, f'{variant}-x{scale:g}')
+    csv_path = f'{base_path}.csv'
+
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f, \
+            open(f'{base_path}.schools.csv', 'w', encoding='utf-8', newline='') as schools_f, \
+            open(f'{base_path}.scores.csv', 'w', encoding='utf-8', newline='') as scores_f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+        schools_writer = csv.writer(schools_f)
+        scores_writer = csv.writer(scores_f)
+        schools_writer.writerow(['region', 'municipality', 'place', 'school', 'school_admin_id'])
+        scores_writer.writerow(['school_admin_id', 'subject', 'people', 'score'])
+
+        header = _header_lines(variant)
+        # the real files start with BOM and contain NBSP in the header
+        f.write(BOM)
+        for line in header:
+            if 'Училище' in line:
+                line[line.index('Училище')] = 'Училище' + NBSP
+        writer.writerows(header)
+
+        for i in range(rows_count):
+            (region, mun, places), (exp_region, exp_mun, exp_places) = PLACES[i % len(PLACES)]
+            place = places[i % len(places)]
+            exp_place = exp_places[i % len(exp_places)]
+
+            school_id = str(100000 + i)
+            raw_school_id = school_id[:3] + ' ' + school_id[3:] if i % 7 == 0 else school_id
+            school = f'Училище {i} "Име"'
+
+            # some rows do not have municipality, the region is used instead
+            if i % 50 == 3:
+                mun = ''
+                exp_mun = exp_region
+
+            values = []
+            for _, subject_id in subjects:
+                people = rng.randint(0, 60) if i % 11 else ''
+                score = round(rng.uniform(2, 6), 2) if is_dzi else round(rng.uniform(1, 100), 2)
+                if people in ('', 0):
+                    score = ''
+                elif subject_id:
+                    scores_writer.writerow([school_id, subject_id, people, score])
+
+                if is_dzi and score != '':
+                    # DZI files use decimal comma
+                    score = str(score).replace('.', ',')
+                values.append((people, score))
+
+            school_values = dict(region=region, municipality=mun, place=place, school=school, school_admin_id=raw_school_id)
+            row = [school_values[c] for c in _school_columns_order(variant)]
+            if paired:
+                row += sum([[p, s] for p, s in values], [])
+            else:
+                row += [p for p, _ in values] + [s for _, s in values]
+            writer.writerow(row)
+
+            schools_writer.writerow([exp_region, exp_mun, exp_place, school, school_id])
+
+    return csv_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generates synthetic NVO and DZI CSV files.')
+    parser.add_argument('--scale', type=float, nargs='*', default=[1], help=f'Scale factors, 1 is {BASE_ROWS} rows. By default 1.')
+    parser.add_argument('--variants', type=str, nargs='*', choices=list(VARIANTS), default=list(VARIANTS), help='By default all variants.')
+    parser.add_argument('--output-dir', type=str, default=BENCHMARK_DIR, help=f'By default {BENCHMARK_DIR}')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for scale in args.scale:
+        for variant in args.variants:
+            print(generate(variant, scale, args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Change plan of the examination scores computed in dry-run mode.
+
+Instead of checking the scores row by row, the examination scores already
+in the database are loaded with one query and compared in memory with the
+scores from the CSV file. The result describes what a real import would
+do - how many scores would be inserted, updated or left unchanged, per
+subject, with sample rows and optionally a CSV file with all changes.
+"""
+
+import pandas as pd
+
+from collections import defaultdict
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from typing import Iterable
+
+from .db_actions import ImportAction
+from .db_models import ExaminationScore
+from .runtime import getLogger
+
+
+logger = getLogger(__name__)
+
+
+# The values of the `change` column of the plan.
+INSERT = 'insert'
+UPDATE = 'update'
+UNCHANGED = 'unchanged'
+UNKNOWN_SCHOOL = 'unknown_school'
+
+_CHANGE_ACTIONS = {
+    INSERT: ImportAction.Insert,
+    UPDATE: ImportAction.Update,
+    UNCHANGED: ImportAction.AlreadyExists,
+    UNKNOWN_SCHOOL: ImportAction.Failed,
+}
+
+# The number of changed rows logged as sample.
+SAMPLE_SIZE = 10
+
+_KEY = ['school_admin_id', 'subject']
+
+
+def load_scores_snapshot(session: Session, examination_id: str) -> pd.DataFrame:
+    """
+    Returns all scores of the examination with columns named as in the
+    result of extract_scores_data() - school_admin_id, subject, people, score.
+    """
+    records = session.execute(
+        select(
+            ExaminationScore.c.school_id, ExaminationScore.c.subject,
+            ExaminationScore.c.people, ExaminationScore.c.score
+        ).where(ExaminationScore.c.examination_id == examination_id)
+    )
+    snapshot = pd.DataFrame(records.all(), columns=['school_admin_id', 'subject', 'people', 'score'])
+    # the scores are Decimal, the ones from the CSV are float
+    snapshot['score'] = snapshot['score'].astype(float)
+
+    return snapshot
+
+
+class ScoresChangePlan:
+    """
+    Collects the changes of the scores of one examination. The scores are
+    added with add(), once for the whole file or once per chunk.
+    """
+
+    def __init__(self, examination_id: str, snapshot: pd.DataFrame):
+        self.examination_id = examination_id
+        self.snapshot = snapshot.set_index(_KEY)
+        self.counts = defaultdict(int)
+        self.counts_by_subject = defaultdict(lambda: defaultdict(int))
+        self.changes = []
+
+    def add(self, scores: pd.DataFrame, known_school_ids: Iterable[str]):
+        """
+        The `known_school_ids` are the ids of the schools which exist in the
+        database or would be imported before the scores. The scores of the
+        other schools would fail because of the foreign key.
+        """
+        plan = scores.loc[:, [*_KEY, 'people', 'score']].join(
+            self.snapshot, on=_KEY, rsuffix='_db'
+        )
+
+        is_known_school = plan['school_admin_id'].isin(set(known_school_ids))
+        is_new = plan['people_db'].isna()
+        is_changed = (plan['people'] != plan['people_db']) | (plan['score'] != plan['score_db'])
+
+        plan['change'] = UNCHANGED
+        plan.loc[is_changed, 'change'] = UPDATE
+        plan.loc[is_new, 'change'] = INSERT
+        plan.loc[~is_known_school, 'change'] = UNKNOWN_SCHOOL
+
+        for (change, subject), count in plan.groupby(['change', 'subject']).size().items():
+            self.counts[change] += int(count)
+            self.counts_by_subject[subject][change] += int(count)
+
+        self.changes.append(plan[plan['change'] != UNCHANGED])
+
+    def ops_count(self) -> dict[ImportAction, int]:
+        return {_CHANGE_ACTIONS[change]: count for change, count in self.counts.items()}
+
+    def get_changes(self) -> pd.DataFrame:
+        if not self.changes:
+            return pd.DataFrame(columns=[*_KEY, 'people', 'score', 'people_db', 'score_db', 'change'])
+        return pd.concat(self.changes, ignore_index=True)
+
+    def log(self):
+        logger.info('Change plan of examination %s: %s', self.examination_id, dict(self.counts))
+        for subject, counts in sorted(self.counts_by_subject.items()):
+            logger.info('  %-10s %s', subject, dict(counts))
+
+        changes = self.get_changes()
+        for change, rows in changes.groupby('change'):
+            logger.info('Sample of %d %s rows:\n%s', min(len(rows), SAMPLE_SIZE), change, rows.head(SAMPLE_SIZE).to_string(index=False))
+
+    def write_csv(self, plan_file: str):
+        self.get_changes().to_csv(plan_file, index=False)
+        logger.info('All changes of examination %s are written in %s', self.examination_id, plan_file)
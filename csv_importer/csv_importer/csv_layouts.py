@@ -0,0 +1,220 @@
+"""
+Registry of the known layouts of the NVO and DZI CSV file headers.
+
+The header of a CSV file consists of the line with the column names and
+the optional lines with column options, check the documentation of
+refine_csv_column_names() in refine_csv.py for the variations.
+
+Each known layout is identified by the fingerprint of its header lines and
+holds the refined column names, so the files with known layout skip the
+header heuristics in refine_csv.py. The same layout is used by the
+examinations with different max possible scores, e.g. 65 and 100 points
+for NVO, so the known layouts leave the max possible score to be inferred
+from the data.
+
+The registry holds several NVO layouts and the layouts of the DZI files
+from 2017 to 2023 listed in new_sources.csv. DZI 2016 is not registered,
+because it has no school ids, it goes through the heuristics as the rest
+of the unregistered layouts.
+
+To add a new layout run `python -m csv_importer.refine_csv <csv-file>`,
+it logs the layout found for the file, then copy it below and give it
+a proper name.
+"""
+
+import hashlib
+
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+
+@dataclass(frozen=True)
+class CsvLayout:
+    """
+    * `name` - describes the first file in which the layout was found,
+      e.g. nvo-4-2023
+    * `header_lines` - the header lines after the cleaning done by
+      refine_csv.open_csv(), without the line endings
+    * `column_names` - the refined column names
+    * `max_possible_score` - optional, when it is None the max possible
+      score is inferred from the data, set it only for a layout used by
+      a single examination
+    """
+    name: str
+    header_lines: tuple[str, ...]
+    column_names: tuple[str, ...]
+    max_possible_score: Optional[float] = None
+
+    @property
+    def fingerprint(self) -> str:
+        return header_fingerprint(self.header_lines)
+
+
+def header_fingerprint(header_lines: Sequence[str]) -> str:
+    text = '\n'.join(line.strip() for line in header_lines)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+KNOWN_LAYOUTS = [
+    CsvLayout(
+        name='nvo-4-2019',
+        header_lines=(
+            '"Област","Община","Населено място","Код","Училище","Явили се МАТ","Явили се БЕЛ","Явили се ЧО","Явили се ЧП","Ср. успех в точки МАТ","Ср. успех в точки БЕЛ","Ср. успех в точки ЧО","Ср. успех в точки ЧП"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school_admin_id', 'school',
+            'мат people', 'бел people', 'чо people', 'чп people',
+            'мат score', 'бел score', 'чо score', 'чп score',
+        ),
+    ),
+    CsvLayout(
+        name='nvo-4-2022',
+        header_lines=(
+            '"Област","Община","Населено място","Училище","Код по АДМИН","БЕЛ Явили се","БЕЛ Ср. успех в точки","МАТ Явили се","МАТ  Ср. успех в точки"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school', 'school_admin_id',
+            'бел people', 'бел score', 'мат people', 'мат score',
+        ),
+    ),
+    CsvLayout(
+        name='nvo-4-2023',
+        header_lines=(
+            '"Област","Община","Населено място","Училище","Код по Админ","БЕЛ","","МАТ",""',
+            '"","","","","","Явили се","Ср. успех в точки","Явили се","Ср. успех в точки"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school', 'school_admin_id',
+            'бел people', 'бел score', 'мат people', 'мат score',
+        ),
+    ),
+    CsvLayout(
+        name='nvo-7-2021',
+        header_lines=(
+            '"Област","Община","Населено място","Училище","Код по Админ","Явили се","Ср. успех в точки","Явили се","Ср. успех в точки"',
+            '"","","","","","БЕЛ","БЕЛ","МАТ","МАТ"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school', 'school_admin_id',
+            'бел people', 'бел score', 'мат people', 'мат score',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2017',
+        header_lines=(
+            '"Област","Община","Населено място","Код по Админ","Училище","БЕЛ Ср.Усп","БЕЛ Бр.","МАТ Ср.Усп","МАТ Бр.","ИЦ Ср.Усп","ИЦ Бр.","ФА Ср.Усп","ФА Бр.","ГИ Ср.Усп","ГИ Бр.","ХООС Ср.Усп","ХООС Бр.","ФИЛ Ср.Усп","ФИЛ Бр.","БЗО Ср.Усп","БЗО Бр.","АЕ Ср.Усп","АЕ Бр.","РЕ Ср.Усп","РЕ Бр.","НЕ Ср.Усп","НЕ Бр.","ИспЕ Ср.Усп","ИспЕ Бр.","ФрЕ Ср.Усп","ФрЕ Бр.","ИтЕ Ср.Усп","ИтЕ Бр.","2ДЗИ Ср.Усп","2ДЗИ Бр.","ср.успех","общо"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school_admin_id', 'school',
+            'бел score', 'бел people', 'мат score', 'мат people', 'иц score',
+            'иц people', 'фа score', 'фа people', 'ги score', 'ги people',
+            'хоос score', 'хоос people', 'фил score', 'фил people', 'бзо score',
+            'бзо people', 'ае score', 'ае people', 'ре score', 'ре people',
+            'не score', 'не people', 'испе score', 'испе people', 'фре score',
+            'фре people', 'ите score', 'ите people', '2дзи score',
+            '2дзи people', 'score', 'общо',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2018',
+        header_lines=(
+            '"Област","Община","Населено място","Код по Админ","Училище","БЕЛ Брой","БЕЛ Ср.успех","МАТ Брой","МАТ Ср.успех","ИЦ Брой","ИЦ Ср.успех","ФА Брой","ФА Ср.успех","ГИ Брой","ГИ Ср.успех","ХООС Брой","ХООС Ср.успех","ФИЛ Брой","ФИЛ Ср.успех","БЗО Брой","БЗО Ср.успех","АЕ Брой","АЕ Ср.успех","РЕ Брой","РЕСр.успех","НЕ Брой","НЕ Ср.успех","ИспЕ Брой","ИспЕ Ср.успех","ФрЕ Брой","ФрЕ Ср.успех","ИтЕ Брой","ИтЕ Ср.успех","2ДЗИ Брой","2ДЗИ Ср.успех","общо Брой","общо Ср.успех"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school_admin_id', 'school',
+            'бел people', 'бел score', 'мат people', 'мат score', 'иц people',
+            'иц score', 'фа people', 'фа score', 'ги people', 'ги score',
+            'хоос people', 'хоос score', 'фил people', 'фил score',
+            'бзо people', 'бзо score', 'ае people', 'ае score', 'ре people',
+            'ре score', 'не people', 'не score', 'испе people', 'испе score',
+            'фре people', 'фре score', 'ите people', 'ите score', '2дзи people',
+            '2дзи score', 'общо people', 'общо score',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2019',
+        header_lines=(
+            '"Област","Община","Населено място","Код по Админ","Училище","БЕЛ Брой","БЕЛ Ср.успех","МАТ Брой","МАТ Ср.успех","ИСТ Брой","ИСТ Ср.успех","ФА Брой","ФА Ср.успех","ГЕО Брой","ГЕО Ср.успех","ХООС Брой","ХООС Ср.успех","ФИЛ Брой","ФИЛ Ср.успех","БЗО Брой","БЗО Ср.успех","АЕ Брой","АЕ Ср.успех","РЕ Брой","РЕ Ср.успех","НЕ Брой","НЕ Ср.успех","ИспЕ Брой","ИспЕ Ср.успех","ФрЕ Брой","ФрЕ Ср.успех","ИтЕ Брой","ИтЕ Ср.успех"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school_admin_id', 'school',
+            'бел people', 'бел score', 'мат people', 'мат score', 'ист people',
+            'ист score', 'фа people', 'фа score', 'гео people', 'гео score',
+            'хоос people', 'хоос score', 'фил people', 'фил score',
+            'бзо people', 'бзо score', 'ае people', 'ае score', 'ре people',
+            'ре score', 'не people', 'не score', 'испе people', 'испе score',
+            'фре people', 'фре score', 'ите people', 'ите score',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2020',
+        header_lines=(
+            '"Област","Община","Населено място","Код по Админ","Училище","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех","Брой","Ср.успех"',
+            '"","","","","","БЕЛ","БЕЛ","МАТ","МАТ","ИСТ","ИСТ","ФА","ФА","ГЕО","ГЕО","ХООС","ХООС","ФИЛ","ФИЛ","БЗО","БЗО","АЕ","АЕ","РЕ","РЕ","НЕ","НЕ","ИспЕ","ИспЕ","ФрЕ","ФрЕ","ИтЕ","ИтЕ","2ДЗИ","2ДЗИ","общо","общо"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school_admin_id', 'school',
+            'бел people', 'бел score', 'мат people', 'мат score', 'ист people',
+            'ист score', 'фа people', 'фа score', 'гео people', 'гео score',
+            'хоос people', 'хоос score', 'фил people', 'фил score',
+            'бзо people', 'бзо score', 'ае people', 'ае score', 'ре people',
+            'ре score', 'не people', 'не score', 'испе people', 'испе score',
+            'фре people', 'фре score', 'ите people', 'ите score', '2дзи people',
+            '2дзи score', 'общо people', 'общо score',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2022',
+        header_lines=(
+            '"Област","Община","Населено място","Училище","Код по Админ","Бр. БЕЛ(ООП) З","Ср.усп.  БЕЛ(ООП) З","Бр. Мат(ПП) З","Ср.усп. Мат(ПП) З","Бр. Ист(ПП) З","Ср.усп. Ист(ПП) З","Бр. ФА(ПП) З","Ср.усп. ФА(ПП) З","Бр. ГИ(ПП) З","Ср.усп. ГИ(ПП) З","Бр. ХООС(ПП) З","Ср.усп. ХООС(ПП) З","Бр. Фил(ПП) З","Ср.усп. Фил(ПП) З","Бр. БЗО(ПП) З","Ср.усп. БЗО(ПП) З","Бр. Инф(ПП) З","Ср.усп. Инф(ПП) З","Бр. ИТ(ПП) З","Ср.усп. ИТ(ПП)З","Бр. МУЗ(ПП) З","Ср.усп. МУЗ(ПП) З","Бр. ИИ(ПП) З","Ср.усп. ИИ(ПП) З","Бр. Пр(ПП) З","Ср.усп. Пр(ПП) З","Бр. АЕ(ПП) B1-З","Ср.усп. АЕ(ПП) B1-З","Бр. АЕ(ПП) B1.1-З","Ср.усп. АЕ(ПП) B1.1-З","Бр. АЕ(ПП) B2-З","Ср.усп.  АЕ(ПП) B2-З","Бр. РЕ(ПП) B1-З","Ср.усп. РЕ(ПП) B1-З","Бр. РЕ(ПП) B1.1-З","Ср.усп. РЕ(ПП) B1.1-З","Бр. РЕ(ПП) B2-З","Ср.усп.  РЕ(ПП) B2-З","Бр. НЕ(ПП) B1-З","Ср.усп. НЕ(ПП) B1-З","Бр. НЕ(ПП) B1.1-З","Ср.усп. НЕ(ПП) B1.1-З","Бр. НЕ(ПП) B2-З","Ср.усп. НЕ(ПП) B2-З","Бр. ИЕ(ПП) B1-З","Ср.усп.  ИЕ(ПП) B1-З","Бр. ИЕ(ПП) B1.1-З","Ср.усп. ИЕ(ПП) B1.1-З","Бр. ИЕ(ПП) B2-З","Ср.усп. ИЕ(ПП) B2-З","Бр. ФЕ(ПП) B1-З","Ср.усп. ФЕ(ПП) B1-З","Бр. ФЕ(ПП) B1.1-З","Ср.усп. ФЕ(ПП) B1.1-З","Бр. ФЕ(ПП)  B2-З","Ср.усп. ФЕ(ПП)  B2-З","Бр. ИТЕ(ПП) B1-З","Ср.усп. ИТЕ(ПП) B1-З","Бр. ИТЕ(ПП) B1.1-З","Ср.усп.  ИТЕ(ПП) B1.1-З","Бр. ИТЕ(ПП) B2-З","Ср.усп. ИТЕ(ПП) B2-З","Бр. ДИППК З","Ср.усп. ДИППК З","Бр. ДИППК-Пр З","Ср.усп. ДИППК-Пр З"',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school', 'school_admin_id',
+            'бел people', 'бел score', 'мат people', 'мат score', 'ист people',
+            'ист score', 'фа people', 'фа score', 'ги people', 'ги score',
+            'хоос people', 'хоос score', 'фил people', 'фил score',
+            'бзо people', 'бзо score', 'инф people', 'инф score', 'ит people',
+            'ит score', 'муз people', 'муз score', 'ии people', 'ии score',
+            'пр people', 'пр score', 'ае-б1 people', 'ае-б1 score',
+            'ае-б1.1 people', 'ае-б1.1 score', 'ае-б2 people', 'ае-б2 score',
+            'ре-б1 people', 'ре-б1 score', 'ре-б1.1 people', 'ре-б1.1 score',
+            'ре-б2 people', 'ре-б2 score', 'не-б1 people', 'не-б1 score',
+            'не-б1.1 people', 'не-б1.1 score', 'не-б2 people', 'не-б2 score',
+            'ие-б1 people', 'ие-б1 score', 'ие-б1.1 people', 'ие-б1.1 score',
+            'ие-б2 people', 'ие-б2 score', 'фе-б1 people', 'фе-б1 score',
+            'фе-б1.1 people', 'фе-б1.1 score', 'фе-б2 people', 'фе-б2 score',
+            'ите-б1 people', 'ите-б1 score', 'ите-б1.1 people',
+            'ите-б1.1 score', 'ите-б2 people', 'ите-б2 score', 'диппк people',
+            'диппк score', 'диппк-пр people', 'диппк-пр score',
+        ),
+    ),
+    CsvLayout(
+        name='dzi-2023',
+        header_lines=(
+            '"Област","Община","Населено място","Училище","Код по Админ","БЕЛ(ООП)","","Мат(ПП)","","Ист(ПП)","","ФА(ПП)","","ГИ(ПП)","","ХООС(ПП)","","Фил(ПП)","","БЗО(ПП)","","Инф(ПП)","","ИТ(ПП)","","МУЗ(ПП)","","ИИ(ПП)","","Пр(ПП)","","АЕ(ПП)","","","","","","РЕ(ПП)","","","","","","НЕ(ПП)","","","","","","ИсЕ(ПП)","","","","","","ФЕ(ПП)","","","","","","ИтЕ(ПП)","","","","","","ДИППК-п.р","","ДИППК-тест","","ДИППК-Д.Пр","","ДИППК-пр.",""',
+            '"","","","","","З","","З","","З","","З","","З","","З","","З","","З","","З","","З","","З","","З","","З","","B1-З","","B1.1-З","","B2-З","","B1-З","","B1.1-З","","B2-З","","B1-З","","B1.1-З","","B2-З","","B1-З","","B1.1-З","","B2-З","","B1-З","","B1.1-З","","B2-З","","B1-З","","B1.1-З","","B2-З","","З","","З","","З","","З",""',
+            '"","","","","","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп.","Бр.","Ср.усп."',
+        ),
+        column_names=(
+            'region', 'municipality', 'place', 'school', 'school_admin_id',
+            'бел people', 'бел score', 'мат people', 'мат score', 'ист people',
+            'ист score', 'фа people', 'фа score', 'ги people', 'ги score',
+            'хоос people', 'хоос score', 'фил people', 'фил score',
+            'бзо people', 'бзо score', 'инф people', 'инф score', 'ит people',
+            'ит score', 'муз people', 'муз score', 'ии people', 'ии score',
+            'пр people', 'пр score', 'ае-б1 people', 'ае-б1 score',
+            'ае-б1.1 people', 'ае-б1.1 score', 'ае-б2 people', 'ае-б2 score',
+            'ре-б1 people', 'ре-б1 score', 'ре-б1.1 people', 'ре-б1.1 score',
+            'ре-б2 people', 'ре-б2 score', 'не-б1 people', 'не-б1 score',
+            'не-б1.1 people', 'не-б1.1 score', 'не-б2 people', 'не-б2 score',
+            'исе-б1 people', 'исе-б1 score', 'исе-б1.1 people',
+            'исе-б1.1 score', 'исе-б2 people', 'исе-б2 score', 'фе-б1 people',
+            'фе-б1 score', 'фе-б1.1 people', 'фе-б1.1 score', 'фе-б2 people',
+            'фе-б2 score', 'ите-б1 people', 'ите-б1 score', 'ите-б1.1 people',
+            'ите-б1.1 score', 'ите-б2 people', 'ите-б2 score',
+            'диппк-п.р people', 'диппк-п.р score', 'диппк-тест people',
+            'диппк-тест score', 'диппк-д.пр people', 'диппк-д.пр score',
+            'диппк-пр people', 'диппк-пр score',
+        ),
+    ),
+]
@@ -1,17 +1,35 @@
+import csv
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
 from enum import Enum
-from sqlalchemy import insert, select, update, Table
+from io import StringIO
+from sqlalchemy import text as raw_statement, insert, select, update, or_, tuple_, literal_column, Table
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from collections import OrderedDict
-from typing import Any
+from collections import OrderedDict, defaultdict
+from typing import Any, Iterable
 
-from .db_models import Subject, Place, School, Examination, ExaminationScore, EDIT_STAMP
+from .db_models import Subject, Place, School, Examination, ExaminationScore, ImportLog, WikidataSync, EDIT_STAMP
 from .runtime import getLogger, is_dry_run, edit_stamp
 
 
 logger = getLogger(__name__)
 
 
+# The number of rows written with one multi-row INSERT ... ON CONFLICT statement
+# by bulk_upsert_objects.
+DEFAULT_BULK_BATCH_SIZE = 5000
+
+# The number of insert_or_update_object operations committed together
+# inside commit_batches().
+DEFAULT_COMMIT_BATCH_SIZE = 500
+
+# The key in Session.info which holds the state of commit_batches()
+_COMMIT_BATCH = 'commit_batch'
+
+
 class ImportAction(Enum):
     """
     It is used as result of some of the methods below. It could be used
@@ -25,6 +43,56 @@ class ImportAction(Enum):
     Skipped = 4
 
 
+@contextmanager
+def commit_batches(session: Session, batch_size: int = DEFAULT_COMMIT_BATCH_SIZE):
+    """
+    Context manager which turns on batched transaction mode for the session.
+
+    By default insert_or_update_object commits after each insert or update
+    and rolls back the whole session on IntegrityError. Inside this context:
+    * every insert or update is wrapped in a SAVEPOINT, so a failing row is
+      rolled back alone and counted as ImportAction.Failed, while the other
+      rows in the batch are kept
+    * the session is committed after every batch_size operations and when
+      the context exits without exception
+
+    Nested usages share the batch of the outermost one.
+    """
+    if _COMMIT_BATCH in session.info:
+        yield session
+        return
+
+    session.info[_COMMIT_BATCH] = {'size': batch_size, 'pending': 0}
+    try:
+        yield session
+        session.commit()
+    finally:
+        session.info.pop(_COMMIT_BATCH, None)
+
+
+def _in_commit_batch(session: Session) -> bool:
+    return _COMMIT_BATCH in session.info
+
+
+def _row_transaction(session: Session):
+    """
+    Returns the context in which a single row is written, check commit_batches().
+    """
+    return session.begin_nested() if _in_commit_batch(session) else nullcontext()
+
+
+def _commit(session: Session):
+    batch = session.info.get(_COMMIT_BATCH)
+    if batch is None:
+        session.commit()
+        return
+
+    batch['pending'] += 1
+    if batch['pending'] >= batch['size']:
+        session.commit()
+        batch['pending'] = 0
+
+
 def insert_or_update_object(session: Session, model: Table, id_col: Any, values: OrderedDict) -> ImportAction:
     edit_stamp_col = None
     if EDIT_STAMP in model.columns:
@@ -59,12 +127,13 @@ def insert_or_update_object(session: Session, model: Table, id_col: Any, values:
                     if edit_stamp_col is not None:
                         values_for_update[edit_stamp_col] = edit_stamp()
 
-                    session.execute(
-                        update(model)
-                        .where(*where_filters)
-                        .values(values_for_update)
-                    )
-                    session.commit()
+                    with _row_transaction(session):
+                        session.execute(
+                            update(model)
+                            .where(*where_filters)
+                            .values(values_for_update)
+                        )
+                    _commit(session)
 
                 logger.verbose_info('Updated %s from %s to %s', model.name, first, input_tuple)
                 return ImportAction.Update
@@ -76,20 +145,160 @@ def insert_or_update_object(session: Session, model: Table, id_col: Any, values:
                     values_for_update = values.copy()
                     values_for_update[edit_stamp_col] = edit_stamp()
 
-                session.execute(
-                    insert(model)
-                    .values(values_for_update)
-                )
-                session.commit()
+                with _row_transaction(session):
+                    session.execute(
+                        insert(model)
+                        .values(values_for_update)
+                    )
+                _commit(session)
 
             logger.verbose_info('Inserted %s %s', model.name, input_tuple)
             return ImportAction.Insert
     except IntegrityError as e:
         logger.error('Failed to process %s item %s because %s', model.name, input_tuple, e)
-        session.rollback()
+        # in batched mode only the savepoint of the row is rolled back
+        if not _in_commit_batch(session):
+            session.rollback()
         return ImportAction.Failed
 
 
+def _dry_run_batch(session: Session, model: Table, id_cols: list, value_cols: list, batch: list[dict]) -> dict[ImportAction, int]:
+    """
+    Computes what bulk_upsert_objects would do with the batch, without
+    changing the database. The existing rows are loaded with one SELECT.
+    """
+    counts = defaultdict(int)
+    id_names = [c.name for c in id_cols]
+
+    existing = {}
+    records = session.execute(
+        select(*id_cols, *[model.c[c] for c in value_cols]).
+        where(tuple_(*id_cols).in_([tuple(row[c] for c in id_names) for row in batch]))
+    )
+    for r in records:
+        existing[tuple(r[:len(id_cols)])] = tuple(r[len(id_cols):])
+
+    for row in batch:
+        key = tuple(row[c] for c in id_names)
+        values = tuple(row[c] for c in value_cols)
+        if key not in existing:
+            logger.verbose_info('Inserted %s %s', model.name, key + values)
+            counts[ImportAction.Insert] += 1
+        elif existing[key] != values:
+            logger.verbose_info('Updated %s from %s to %s', model.name, key + existing[key], key + values)
+            counts[ImportAction.Update] += 1
+        else:
+            counts[ImportAction.AlreadyExists] += 1
+
+    return counts
+
+
+def _upsert_batch(session: Session, model: Table, id_cols: list, value_cols: list, batch: list[dict]) -> dict[ImportAction, int]:
+    """
+    Writes the batch with one INSERT ... ON CONFLICT DO UPDATE statement.
+    Existing rows are updated only when at least one of their values differs.
+
+    The statement returns `xmax = 0` only for the inserted and the updated
+    rows - it is true for inserted rows and false for updated ones.
+    All other rows in the batch are already in the database.
+    """
+    counts = defaultdict(int)
+
+    stmt = pg_insert(model).values(batch)
+    if value_cols:
+        set_ = {c: stmt.excluded[c] for c in value_cols}
+        if EDIT_STAMP in model.columns:
+            set_[EDIT_STAMP] = stmt.excluded[EDIT_STAMP]
+
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[c.name for c in id_cols],
+            set_=set_,
+            where=or_(*[model.c[c].is_distinct_from(stmt.excluded[c]) for c in value_cols])
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[c.name for c in id_cols])
+
+    stmt = stmt.returning(literal_column('(xmax = 0)').label('inserted'))
+
+    for (inserted,) in session.execute(stmt):
+        counts[ImportAction.Insert if inserted else ImportAction.Update] += 1
+
+    counts[ImportAction.AlreadyExists] += len(batch) - sum(counts.values())
+
+    return counts
+
+
+def bulk_upsert_objects(session: Session, model: Table, id_cols: list, rows: Iterable[dict], batch_size: int = DEFAULT_BULK_BATCH_SIZE) -> dict[ImportAction, int]:
+    """
+    Bulk version of insert_or_update_object. The rows are dictionaries
+    where the keys are column names of the model. All rows should contain
+    the same set of columns.
+
+    The rows are written in batches with postgres specific
+    `INSERT ... ON CONFLICT (<id_cols>) DO UPDATE ... WHERE <values differ>`
+    statement and every batch is committed.
+
+    If a batch fails with IntegrityError (for example unknown foreign key),
+    its savepoint is rolled back and its rows are processed one by one with
+    insert_or_update_object inside commit_batches(), so only the bad rows
+    are counted as Failed.
+
+    If the same id is found more than once in the rows, only the last row
+    is written, the others are counted as Skipped. Postgres does not allow
+    one INSERT ... ON CONFLICT statement to change the same row twice.
+
+    Returns the number of rows per ImportAction, the same way as the callers
+    of insert_or_update_object do.
+    """
+    counts = defaultdict(int)
+    id_names = [c.name for c in id_cols]
+
+    unique_rows = {}
+    for row in rows:
+        key = tuple(row[c] for c in id_names)
+        if key in unique_rows:
+            logger.warning('Skipping duplicated %s %s', model.name, unique_rows[key])
+            counts[ImportAction.Skipped] += 1
+        unique_rows[key] = row
+
+    if not unique_rows:
+        return counts
+
+    all_rows = list(unique_rows.values())
+    value_cols = [c for c in all_rows[0] if c not in id_names and c != EDIT_STAMP]
+
+    if EDIT_STAMP in model.columns and not is_dry_run():
+        stamp = edit_stamp()
+        all_rows = [{**row, EDIT_STAMP: stamp} for row in all_rows]
+
+    for start in range(0, len(all_rows), batch_size):
+        batch = all_rows[start:start + batch_size]
+
+        if is_dry_run():
+            batch_counts = _dry_run_batch(session, model, id_cols, value_cols, batch)
+        else:
+            try:
+                with session.begin_nested():
+                    batch_counts = _upsert_batch(session, model, id_cols, value_cols, batch)
+                session.commit()
+            except IntegrityError as e:
+                logger.warning('Failed to bulk write %d %s rows, will write them one by one, because %s', len(batch), model.name, e)
+                batch_counts = defaultdict(int)
+                with commit_batches(session):
+                    for row in batch:
+                        values = OrderedDict(
+                            (model.c[c], v) for c, v in row.items() if c != EDIT_STAMP
+                        )
+                        batch_counts[insert_or_update_object(session, model, id_cols, values)] += 1
+
+        for action, count in batch_counts.items():
+            counts[action] += count
+
+        logger.verbose_info('Written %d of %d %s rows', start + len(batch), len(all_rows), model.name)
+
+    return counts
+
+
 def insert_place(session: Session, place_name: str, place_type: str, mun_id: str, region_id: str) -> str:
     place_id = f'{region_id}-{mun_id}-{place_type}-{place_name}'
 
@@ -119,8 +328,45 @@ def insert_school(session: Session, place_id: int, school_id: str, school_name:
     ]))
 
 
+def get_existing_school_ids(session: Session, school_ids: Iterable[str]) -> set[str]:
+    """
+    Returns those of the specified school ids which are found in the database.
+    All ids are checked with one query.
+    """
+    school_ids = list(school_ids)
+    if not school_ids:
+        return set()
+
+    records = session.execute(
+        select(School.c.id).where(School.c.id.in_(school_ids))
+    )
+
+    return {r[0] for r in records}
+
+
+def insert_schools(session: Session, schools: Iterable[tuple[str, str, str]]) -> dict[ImportAction, int]:
+    """
+    Bulk version of insert_school. The schools are tuples
+    (place_id, school_id, school_name).
+    """
+    rows = (
+        {
+            School.c.id.name: school_id,
+            School.c.name.name: school_name,
+            School.c.place_id.name: place_id,
+        }
+        for place_id, school_id, school_name in schools
+    )
+
+    return bulk_upsert_objects(session, School, [School.c.id], rows)
+
+
+def get_examination_id(examination_type: str, year: int, grade: int) -> str:
+    return f'{examination_type}-{grade}-{year}'
+
+
 def insert_examination(session: Session, examination_type: str, year: int, grade: int, max_possible_score: float) -> tuple[str, ImportAction]:
-    id = f'{examination_type}-{grade}-{year}'
+    id = get_examination_id(examination_type, year, grade)
     # a bit hacky way to translate, works only for two types
     translated_type = 'НВО' if examination_type == 'nvo' else 'ДЗИ'
 
@@ -150,3 +396,216 @@ def insert_or_update_score(session: Session, examination_id: str, school_id: str
     return insert_or_update_object(
         session, ExaminationScore, id_cols, values
     )
+
+
+def upsert_scores(session: Session, examination_id: str, scores: Iterable[tuple[str, str, int, Any]]) -> dict[ImportAction, int]:
+    """
+    Bulk version of insert_or_update_score. The scores are tuples
+    (school_id, subject, people, score) of the specified examination.
+    """
+    rows = (
+        {
+            ExaminationScore.c.examination_id.name: examination_id,
+            ExaminationScore.c.school_id.name: school_id,
+            ExaminationScore.c.subject.name: subject,
+            ExaminationScore.c.people.name: people,
+            ExaminationScore.c.score.name: score,
+        }
+        for school_id, subject, people, score in scores
+    )
+    id_cols = [ExaminationScore.c.examination_id, ExaminationScore.c.school_id, ExaminationScore.c.subject]
+
+    return bulk_upsert_objects(session, ExaminationScore, id_cols, rows)
+
+
+# The staging table is temporary and exists only in the transaction of
+# copy_scores.
+_SCORES_STAGING_TABLE = 'examination_score_staging'
+
+_CREATE_SCORES_STAGING = f'''
+CREATE TEMPORARY TABLE {_SCORES_STAGING_TABLE} (
+    school_id varchar(10),
+    subject varchar(10),
+    people integer,
+    score numeric
+) ON COMMIT DROP
+'''
+
+_COPY_SCORES_STAGING = f'''
+COPY {_SCORES_STAGING_TABLE} (school_id, subject, people, score) FROM STDIN WITH (FORMAT csv)
+'''
+
+# The staged rows for schools which are not in the database are not merged,
+# they are counted as failed.
+_MERGE_SCORES_STAGING = f'''
+WITH staged AS (
+    SELECT s.school_id, s.subject, s.people, s.score
+    FROM {_SCORES_STAGING_TABLE} s
+    WHERE EXISTS (SELECT 1 FROM school WHERE school.id = s.school_id)
+), merged AS (
+    INSERT INTO examination_score (examination_id, school_id, subject, people, score, edit_stamp)
+    SELECT :examination_id, school_id, subject, people, score, :edit_stamp
+    FROM staged
+    ON CONFLICT (examination_id, school_id, subject) DO UPDATE
+    SET people = excluded.people, score = excluded.score, edit_stamp = excluded.edit_stamp
+    WHERE examination_score.people IS DISTINCT FROM excluded.people
+       OR examination_score.score IS DISTINCT FROM excluded.score
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT
+    (SELECT count(*) FROM {_SCORES_STAGING_TABLE}) AS staged,
+    (SELECT count(*) FROM staged) AS known,
+    count(*) FILTER (WHERE inserted) AS inserted,
+    count(*) FILTER (WHERE NOT inserted) AS updated
+FROM merged
+'''
+
+# The same counts as _MERGE_SCORES_STAGING, but without changing the
+# examination_score table. Used in dry-run mode.
+_DIFF_SCORES_STAGING = f'''
+WITH staged AS (
+    SELECT s.school_id, s.subject, s.people, s.score
+    FROM {_SCORES_STAGING_TABLE} s
+    WHERE EXISTS (SELECT 1 FROM school WHERE school.id = s.school_id)
+)
+SELECT
+    (SELECT count(*) FROM {_SCORES_STAGING_TABLE}) AS staged,
+    count(*) AS known,
+    count(*) FILTER (WHERE e.school_id IS NULL) AS inserted,
+    count(*) FILTER (
+        WHERE e.school_id IS NOT NULL
+          AND (e.people IS DISTINCT FROM s.people OR e.score IS DISTINCT FROM s.score)
+    ) AS updated
+FROM staged s
+LEFT JOIN examination_score e
+    ON e.examination_id = :examination_id
+   AND e.school_id = s.school_id
+   AND e.subject = s.subject
+'''
+
+
+def copy_scores(session: Session, examination_id: str, scores: Iterable[tuple[str, str, int, Any]]) -> dict[ImportAction, int]:
+    """
+    Alternative of upsert_scores for loading all scores of an examination
+    at once. The scores are tuples (school_id, subject, people, score).
+
+    The scores are sent with `COPY FROM STDIN` into a temporary staging table
+    and then merged into examination_score with one set-based statement.
+    Only the inserted and changed rows get new edit_stamp.
+
+    Scores of schools which are not in the database are counted as Failed.
+    If the same (school_id, subject) is found more than once, only the last
+    row is loaded, the others are counted as Skipped.
+
+    In dry-run mode the staging table is compared with examination_score
+    without changing it.
+    """
+    counts = defaultdict(int)
+
+    unique_scores = {}
+    for school_id, subject, people, score in scores:
+        if (school_id, subject) in unique_scores:
+            logger.warning('Skipping duplicated %s %s', ExaminationScore.name, (examination_id, school_id, subject))
+            counts[ImportAction.Skipped] += 1
+        unique_scores[(school_id, subject)] = (school_id, subject, people, score)
+
+    buffer = StringIO()
+    csv.writer(buffer).writerows(unique_scores.values())
+    buffer.seek(0)
+
+    session.execute(raw_statement(_CREATE_SCORES_STAGING))
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(_COPY_SCORES_STAGING, buffer)
+    finally:
+        cursor.close()
+    logger.info('Copied %d rows into %s', len(unique_scores), _SCORES_STAGING_TABLE)
+
+    if is_dry_run():
+        stmt = raw_statement(_DIFF_SCORES_STAGING)
+        params = {'examination_id': examination_id}
+    else:
+        stmt = raw_statement(_MERGE_SCORES_STAGING)
+        params = {'examination_id': examination_id, 'edit_stamp': edit_stamp()}
+
+    staged, known, inserted, updated = session.execute(stmt, params).one()
+    # commit also drops the staging table, in dry-run mode nothing else is changed
+    session.commit()
+
+    if staged != known:
+        logger.error('Cannot find in the database the schools for %d %s rows', staged - known, ExaminationScore.name)
+
+    for action, count in [
+        (ImportAction.Insert, inserted),
+        (ImportAction.Update, updated),
+        (ImportAction.AlreadyExists, known - inserted - updated),
+        (ImportAction.Failed, staged - known),
+    ]:
+        if count:
+            counts[action] += count
+
+    return counts
+
+
+def is_file_imported(session: Session, file_digest: str, examination_id: str, to_import: Iterable[str]) -> bool:
+    """
+    Checks in the import_log table whether a file with file_digest was
+    already imported for the examination. All of to_import (e.g. 'schools'
+    and 'scores') should be imported, possibly by different imports.
+    """
+    records = session.execute(
+        select(ImportLog.c.imported)
+        .where(ImportLog.c.file_digest == file_digest)
+        .where(ImportLog.c.examination_id == examination_id)
+    )
+
+    imported = set()
+    for r in records:
+        imported.update(r[0].split(','))
+
+    return set(to_import) <= imported
+
+
+def insert_import_log(session: Session, file_digest: str, examination_id: str, to_import: Iterable[str], values: dict[str, Any]):
+    """
+    Adds a record in the import_log table, the values are the rest of
+    the columns, e.g. csv_rows, duration, etc.
+    Nothing is written in dry-run mode.
+    """
+    record = {
+        'file_digest': file_digest,
+        'examination_id': examination_id,
+        'imported': ','.join(sorted(to_import)),
+        **values,
+        EDIT_STAMP: edit_stamp(),
+    }
+
+    if is_dry_run():
+        logger.verbose_info('Dry-run, import log is not written: %s', record)
+        return
+
+    session.execute(insert(ImportLog).values(record))
+    session.commit()
+    logger.verbose_info('Written import log: %s', record)
+
+
+def get_wikidata_watermarks(session: Session) -> dict[str, datetime]:
+    """
+    Returns the time of the last import of each wikidata query, check
+    the WikidataSync model.
+    """
+    watermarks = {}
+    for name, synced_at in session.execute(select(WikidataSync.c.name, WikidataSync.c.synced_at)):
+        # sqlite does not keep the time zone
+        watermarks[name] = synced_at if synced_at.tzinfo else synced_at.replace(tzinfo=timezone.utc)
+
+    return watermarks
+
+
+def set_wikidata_watermark(session: Session, name: str, synced_at: datetime, incremental: bool, rows: int) -> ImportAction:
+    return insert_or_update_object(session, WikidataSync, WikidataSync.c.name, OrderedDict([
+        (WikidataSync.c.name, name),
+        (WikidataSync.c.synced_at, synced_at),
+        (WikidataSync.c.incremental, incremental),
+        (WikidataSync.c.rows, rows),
+    ]))
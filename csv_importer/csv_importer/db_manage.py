@@ -8,8 +8,8 @@ from collections import OrderedDict, defaultdict
 
 from .models import SubjectItem, get_default_subjects, FOREIGN_COUNTRY
 from .db import get_db_engine
-from .db_actions import insert_or_update_object
-from .db_models import Examination, ExaminationScore, Subject, Region, Municipality
+from .db_actions import insert_or_update_object, commit_batches
+from .db_models import Examination, ExaminationScore, Subject, Region, Municipality, ImportLog
 from .runtime import is_dry_run, getLogger
 
 
@@ -54,10 +54,9 @@ def init_db():
 
     db = get_db_engine()
 
-    with Session(db) as session:
+    with Session(db) as session, commit_batches(session):
         _init_subjects(session)
         _init_region_and_municipality(session)
-        session.commit()
 
 
 def _init_subjects(session: Session):
@@ -127,4 +126,12 @@ def delete_examination(examination_id: str):
             )
         logger.info('Deleted all examination %s', examination_id)
 
+        # otherwise the examination files would be skipped on the next import
+        if not is_dry_run():
+            session.execute(
+                delete(ImportLog).
+                where(ImportLog.c.examination_id == examination_id)
+            )
+        logger.info('Deleted import log for examination %s', examination_id)
+
         session.commit()
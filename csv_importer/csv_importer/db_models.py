@@ -12,7 +12,7 @@ didn't have any knowledge about SQLAlchemy.
 
 from sqlalchemy import (
     MetaData, Table, Column,
-    Integer, String, ForeignKey, Numeric
+    Integer, String, ForeignKey, Numeric, Index, DateTime, Boolean
 )
 
 Models = MetaData()
@@ -168,3 +168,55 @@ Subject: Table = Table(
     Column('abbreviations', String(30)),
     Column(EDIT_STAMP, EditStampType)
 )
+
+
+# Journal of the imported CSV files. A record is added after each successful
+# import of a CSV file (not in dry-run mode), check import_file() in
+# import_csv.py. A file is not imported again for the same examination
+# when its digest is already in this table, unless it is forced.
+# * file_digest - sha256 of the content of the CSV file
+# * examination_id - the id of the Examination, it is not a foreign key,
+#   because the examination is not inserted when only schools are imported
+# * imported - comma separated list of what is imported, e.g. 'schools,scores'
+# * layout_fingerprint - the fingerprint of the CSV header, check csv_layouts.py
+# * csv_rows, school_rows, score_rows - the number of rows in the CSV file
+#   and the number of extracted schools and examination scores
+# * duration - the import duration in seconds
+ImportLog: Table = Table(
+    'import_log',
+    Models,
+
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('file_digest', String(64), nullable=False),
+    Column('examination_id', String(15), nullable=False),
+    Column('imported', String(30), nullable=False),
+    Column('layout_fingerprint', String(64)),
+    Column('csv_rows', Integer),
+    Column('school_rows', Integer),
+    Column('score_rows', Integer),
+    Column('duration', Numeric),
+    Column(EDIT_STAMP, EditStampType),
+
+    Index('ix_import_log_file_digest', 'file_digest', 'examination_id'),
+)
+
+
+# The watermarks of the wikidata imports, one record per query, check
+# import_from_wikidata() in wikidata.py. The incremental imports ask wikidata
+# only for the entities modified after the watermark.
+# * name - the name of the query, e.g. `region` or `place-село`
+# * synced_at - when the result of the last successful import of the query
+#   was fetched from wikidata, which is older than the import when the
+#   result came from the cache
+# * incremental - whether the last import was incremental
+# * rows - the number of rows returned by the query in the last import
+WikidataSync: Table = Table(
+    'wikidata_sync',
+    Models,
+
+    Column('name', String(30), primary_key=True),
+    Column('synced_at', DateTime(timezone=True), nullable=False),
+    Column('incremental', Boolean, nullable=False),
+    Column('rows', Integer),
+    Column(EDIT_STAMP, EditStampType),
+)
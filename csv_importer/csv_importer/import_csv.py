@@ -1,30 +1,40 @@
+import csv
+import hashlib
 import os
+import time
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
 from decimal import Decimal
 from collections import defaultdict
+from typing import Iterator, Optional, TextIO
 
 from sqlalchemy.engine import Engine
 
 
 from sqlalchemy.orm import Session
-from sqlalchemy import select, func
 
 import pandas as pd
 
 from .db import get_db_engine
 from .db_actions import (
-    insert_examination, insert_or_update_score, check_school_exists,
-    insert_school, insert_place, ImportAction
+    insert_examination, upsert_scores, copy_scores, get_existing_school_ids,
+    insert_schools, insert_place, commit_batches, get_examination_id,
+    is_file_imported, insert_import_log, ImportAction
 )
 from .db_manage import load_subject_abbr_map
-from .runtime import getLogger
+from .runtime import getLogger, enable_verbose_logging, is_verbose, is_dry_run
 from .refine_csv import (
-    load_csv, refine_csv_column_names, refine_data,
+    open_csv, refine_csv_column_names, refine_data, refine_data_chunks,
     extract_school_data, extract_scores_data
 )
 
-from .db_models import Place, Municipality, Region
+from .change_plan import ScoresChangePlan, load_scores_snapshot
+from .csv_layouts import CsvLayout
+from .metrics import ImportReport
 from .models import FOREIGN_COUNTRY
+from .place_resolver import PlaceResolver, get_place_resolver
 
 
 logger = getLogger(__name__)
@@ -32,57 +42,27 @@ logger = getLogger(__name__)
 
 SUPPORTED_IMPORT_CSV_TYPES = ('schools', 'scores')
 
+# How the examination scores are written into the database:
+# * upsert - batched INSERT ... ON CONFLICT statements, suitable for
+#   any import.
+# * copy - all scores are loaded with COPY into a staging table and merged
+#   with one statement. This is the fastest way to (re-)load whole examination.
+SUPPORTED_LOAD_MODES = ('upsert', 'copy')
+
+_DIGEST_BLOCK_SIZE = 1 << 20
+
 
 REGION  = 'region'
 MUN = 'municipality'
 PLACE = 'place'
 
 
-def try_find_place(session: Session, place_name: str, mun: str, region: str) -> str:
-    # Here we have some hardcoded standardizing actions for regions and municipalities.
-
-    if region.lower() == 'софия-град':
-        region = 'София Столица'
-    if region.lower() == 'софия-област':
-        region = 'София'
-
-    if mun.lower() == 'столична':
-        mun = 'Столична община'
-    if mun.lower() == 'гр.добрич':
-        mun = 'Добрич'
-
-    if place_name.startswith('с.'):
-        place_name = place_name.replace('с.', '').strip()
+def _add_ops_count(total: dict[ImportAction, int], ops_count: dict[ImportAction, int]):
+    for action, count in ops_count.items():
+        total[action] += count
 
-    if place_name.startswith('гр.'):
-        place_name = place_name.replace('гр.', '').strip()
 
-    if place_name == 'Карапелит' and mun == 'Добрич':
-        mun = 'Добрич-селска'
-
-    stmt = (
-        select(Place.c.id, Place.c.type, Municipality.c.id, Region.c.id).
-        select_from(
-            Place
-            .join(Municipality, Place.c.municipality_id == Municipality.c.id)
-            .join(Region, Municipality.c.region_id == Region.c.id)
-        ).where(
-            func.lower(Place.c.name) == place_name.lower(),
-            func.lower(Region.c.name) == region.lower(),
-            func.lower(Municipality.c.name) == mun.lower()
-        )
-    )
-
-    first = session.execute(stmt).first()
-    if first and first[0]:
-        logger.verbose_info('Found place: (%s, %s, %s, %s) with id %s', first[1], place_name, mun, region, first[0])
-        return first[0]
-    else:
-        logger.verbose_info('Did not find place: (%s, %s, %s)', place_name, mun, region)
-        return None
-
-
-def _import_schools(db: Engine, schools: pd.DataFrame) -> dict[ImportAction, int]:
+def _import_schools(db: Engine, schools: pd.DataFrame, place_resolver: PlaceResolver) -> dict[ImportAction, int]:
     """
     Imports information for schools. The assumption is that most of the
     schools are already in the database, because they are imported from
@@ -99,67 +79,115 @@ def _import_schools(db: Engine, schools: pd.DataFrame) -> dict[ImportAction, int
     school described in the data frame fully matches the school in the database.
     This means that no additional comparisons are made - the school names are
     not compared, nor are the place, municipality and region.
+
+    The places of the new schools are found with the place_resolver.
     """
 
     schools = schools.sort_values(by=[REGION, MUN, PLACE])
     ops_counts = defaultdict(int)
 
     with Session(db) as session:
-        for i in schools.index:
-            school = schools.loc[i]
-
-            id = school['school_admin_id']
-            school_exists = check_school_exists(session, id)
-            if school_exists:
-                logger.verbose_info('Found school: %s', id)
-                ops_counts[ImportAction.AlreadyExists] += 1
-            else:
+        known_ids = get_existing_school_ids(session, schools['school_admin_id'].unique())
+        is_known = schools['school_admin_id'].isin(known_ids)
+
+        known_count = int(is_known.sum())
+        if known_count:
+            logger.verbose_info('Found %d schools', known_count)
+            ops_counts[ImportAction.AlreadyExists] += known_count
+
+        new_schools = []
+        with commit_batches(session):
+            for school in schools[~is_known].to_dict('records'):
+                id = school['school_admin_id']
                 school_tuple = (id, school['school'], school[REGION], school[MUN], school[PLACE])
                 logger.warning('School does not exist: %s', school_tuple)
-                place_id = try_find_place(session, school[PLACE], school[MUN], school[REGION])
+                place_id = place_resolver.find(session, school[PLACE], school[MUN], school[REGION])
                 if not place_id and FOREIGN_COUNTRY == school[MUN] == school[REGION]:
                     place_id = insert_place(session, school[PLACE], 'град', FOREIGN_COUNTRY, FOREIGN_COUNTRY)
+                    place_resolver.add(place_id, school[PLACE], FOREIGN_COUNTRY, FOREIGN_COUNTRY)
                 if place_id:
-                    r = insert_school(session, place_id, school['school_admin_id'], school['school'])
-                    ops_counts[r] += 1
+                    new_schools.append((place_id, id, school['school']))
                 else:
                     logger.error('Cannot find in the database the place for school: %s', school_tuple)
                     ops_counts[ImportAction.Failed] += 1
 
+        _add_ops_count(ops_counts, insert_schools(session, new_schools))
+
     return ops_counts
 
 
-def _import_scores(db: Engine, examination_type: str, year: int, grade: int, scores: pd.DataFrame) -> dict[ImportAction, int]:
+def _import_examination(db: Engine, examination_type: str, year: int, grade: int, max_possible_score: float) -> str:
+    """
+    Imports information for examination, returns the examination id.
+    """
+
+    with Session(db) as session:
+        exam_id, _ = insert_examination(session, examination_type, year, grade, Decimal(str(max_possible_score)))
+
+    return exam_id
+
+
+def _import_scores(db: Engine, exam_id: str, scores: pd.DataFrame, load_mode: str = 'upsert') -> dict[ImportAction, int]:
     """
-    Imports information for examination and all examination scores.
+    Imports all examination scores for the examination with exam_id.
+    The load_mode is one of SUPPORTED_LOAD_MODES.
     """
 
-    ops_count = defaultdict(int)
     with Session(db) as session:
-        first_score = scores.loc[0]
-        exam_id, _ = insert_examination(session, examination_type, year, grade, Decimal(str(first_score['max_possible_score'])))
-
-        for i in scores.index:
-            score = scores.loc[i]
-            subject = score['subject']
-
-            r = insert_or_update_score(
-                session,
-                exam_id,
-                score['school_admin_id'],
-                subject,
-                int(score['people']),
-                Decimal(str(score['score'])),
+        rows = (
+            (school_id, subject, int(people), Decimal(str(score)))
+            for school_id, subject, people, score in zip(
+                scores['school_admin_id'], scores['subject'], scores['people'], scores['score']
             )
-            ops_count[r] += 1
+        )
+        if load_mode == 'copy':
+            ops_count = copy_scores(session, exam_id, rows)
+        else:
+            ops_count = upsert_scores(session, exam_id, rows)
 
     return ops_count
 
 
-def _validate_args(csv_file: str, examination_type: str, grade: int, year: int):
+def _new_scores_plan(db: Engine, exam_id: str) -> ScoresChangePlan:
+    with Session(db) as session:
+        snapshot = load_scores_snapshot(session, exam_id)
+    logger.info('Loaded %d scores of examination %s for the change plan', len(snapshot), exam_id)
+
+    return ScoresChangePlan(exam_id, snapshot)
+
+
+def _plan_scores(db: Engine, plan: ScoresChangePlan, refined: 'RefinedFile', to_import):
+    """
+    Adds the scores to the dry-run change plan. When the schools are imported
+    too, all schools in the file are assumed to exist before the scores.
+    """
+    if 'schools' in to_import:
+        known_school_ids = refined.schools['school_admin_id'].unique()
+    else:
+        with Session(db) as session:
+            known_school_ids = get_existing_school_ids(session, refined.scores['school_admin_id'].unique())
+
+    plan.add(refined.scores, known_school_ids)
+
+
+def _finish_scores_plan(plan: ScoresChangePlan, plan_file: Optional[str]) -> dict[ImportAction, int]:
+    plan.log()
+    if plan_file:
+        plan.write_csv(plan_file)
+
+    return plan.ops_count()
+
+
+def _validate_args(csv_file: str, examination_type: str, grade: int, year: int, load_mode: str):
     if not os.path.exists(csv_file):
         raise ValueError(f'Filepath {csv_file} does not exist.')
 
+    if load_mode not in SUPPORTED_LOAD_MODES:
+        raise ValueError((
+            f'Unsupported load mode: {load_mode}. '
+            f'Supported load modes are: {SUPPORTED_LOAD_MODES}'
+        ))
+
     if examination_type not in ['dzi', 'nvo']:
         raise ValueError((
             f'Unsupported examination type: {examination_type}. '
@@ -178,35 +206,424 @@ def _validate_args(csv_file: str, examination_type: str, grade: int, year: int):
         ))
 
 
-def import_file(csv_file: str, examination_type: str, grade: int, year: int, to_import=SUPPORTED_IMPORT_CSV_TYPES):
+def import_file(csv_file: str, examination_type: str, grade: int, year: int, to_import=SUPPORTED_IMPORT_CSV_TYPES, load_mode: str = 'upsert', place_resolver: PlaceResolver = None, chunk_size: int = None, force: bool = False, metrics_file: str = None, plan_file: str = None) -> dict:
     """
     Imports CSV file containing NVO or DZI data.
 
+    The load_mode is one of SUPPORTED_LOAD_MODES, check the comment there.
+
+    By default the places of new schools are found with the PlaceResolver
+    shared by all imports in the current process.
+
+    When chunk_size is specified the CSV file is read, refined and written
+    into the DB in chunks of chunk_size rows, check _import_file_chunks().
+
+    Each successful import is recorded in the import_log table. The import
+    is skipped when the same file was already imported for the examination,
+    unless force is True. An import in which some schools or scores failed,
+    e.g. because of unknown schools, is not recorded, so running it again
+    loads the failed rows.
+
+    In dry-run mode the changes of the scores are computed in memory and
+    written in the plan_file when it is specified, check _write_refined().
+
+    Returns the timing and memory report of the import stages, check
+    metrics.py. The report is also logged and appended to the metrics_file
+    when it is specified.
+
     This function is used applications - CLI or DAGs.
     """
 
-    _validate_args(csv_file, examination_type, grade, year)
+    _validate_args(csv_file, examination_type, grade, year, load_mode)
 
-    logger.info('Importing file %s', csv_file)
-    raw_data = load_csv(csv_file)
-    raw_data = refine_csv_column_names(raw_data)
+    started = time.monotonic()
+    db = get_db_engine()
+    exam_id = get_examination_id(examination_type, year, grade)
+    report = ImportReport(csv_file, {'examination_id': exam_id, 'load_mode': load_mode, 'chunk_size': chunk_size})
 
+    with report.stage('digest'):
+        digest = file_digest(csv_file)
+    report.details['file_digest'] = digest
+
+    if not force and _is_file_imported(db, digest, exam_id, to_import):
+        logger.info('File %s with digest %s is already imported for examination %s, skipping it', csv_file, digest, exam_id)
+        report.details['skipped'] = True
+        return report.emit(metrics_file)
+
+    logger.info('Importing file %s', csv_file)
     subject_mapping = load_subject_abbr_map()
-    refined_data = refine_data(raw_data, subject_mapping)
+
+    if 'schools' in to_import and place_resolver is None:
+        place_resolver = get_place_resolver()
+
+    if chunk_size:
+        refined = _import_file_chunks(csv_file, examination_type, grade, year, to_import, load_mode, place_resolver, chunk_size, subject_mapping, report, plan_file)
+    else:
+        refined = refine_file(csv_file, subject_mapping, report)
+        _write_refined(db, examination_type, grade, year, refined, to_import, load_mode, place_resolver, report, plan_file)
+
+    _log_import(db, digest, exam_id, to_import, refined, time.monotonic() - started)
+
+    return report.emit(metrics_file)
+
+
+def file_digest(csv_file: str) -> str:
+    """
+    Returns the sha256 hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        for block in iter(lambda: f.read(_DIGEST_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def _is_file_imported(db: Engine, digest: str, exam_id: str, to_import) -> bool:
+    with Session(db) as session:
+        return is_file_imported(session, digest, exam_id, to_import)
+
+
+def _log_import(db: Engine, digest: str, exam_id: str, to_import, refined: 'RefinedFile', duration: float):
+    if refined.failed_rows:
+        logger.warning('%d rows failed, the import of file with digest %s is not recorded in the import log', refined.failed_rows, digest)
+        return
+
+    with Session(db) as session:
+        insert_import_log(session, digest, exam_id, to_import, {
+            'layout_fingerprint': refined.layout.fingerprint if refined.layout else None,
+            'csv_rows': refined.csv_rows,
+            'school_rows': refined.school_rows,
+            'score_rows': refined.score_rows,
+            'duration': round(duration, 3),
+        })
+
+
+@dataclass
+class RefinedFile:
+    """
+    The result of refine_file(). The frames are not kept in the result of
+    _import_file_chunks(), only the number of their rows.
+    The failed_rows are counted when the file is written into the DB.
+    """
+    layout: Optional[CsvLayout]
+    csv_rows: int
+    school_rows: int
+    score_rows: int
+    schools: Optional[pd.DataFrame] = None
+    scores: Optional[pd.DataFrame] = None
+    failed_rows: int = 0
+
+
+def _extract(raw_data: TextIO, refined_data: pd.DataFrame, report: ImportReport) -> RefinedFile:
+    with report.stage('extract') as stage:
+        schools_data = extract_school_data(refined_data)
+        logger.info('Successfully extracted school data.')
+
+        scores_data = extract_scores_data(refined_data)
+        logger.info('Successfully extracted scores data.')
+        stage.add_rows(len(scores_data))
+
+    return RefinedFile(
+        raw_data.layout, len(refined_data), len(schools_data), len(scores_data),
+        schools_data, scores_data
+    )
+
+
+@contextmanager
+def _open_refined_csv(csv_file: str, report: ImportReport) -> Iterator[TextIO]:
+    """
+    The same as open_csv() followed by refine_csv_column_names(), but both
+    are measured as stages. Note that the lines of the CSV are read lazily,
+    so most of the reading is measured in the refine_data stage.
+    """
+    with ExitStack() as stack:
+        with report.stage('load'):
+            raw_data = stack.enter_context(open_csv(csv_file))
+
+        with report.stage('refine_header'):
+            raw_data = refine_csv_column_names(raw_data)
+
+        yield raw_data
+
+
+def refine_file(csv_file: str, subject_mapping: dict, report: ImportReport = None) -> RefinedFile:
+    """
+    Loads and refines the CSV file, returns the school data and the scores
+    data extracted from it. It does not use the database, so it could be
+    run in another process, check import_batch().
+
+    The refine stages are measured in the report when it is specified.
+    """
+    if report is None:
+        report = ImportReport(csv_file)
+
+    with _open_refined_csv(csv_file, report) as raw_data:
+        with report.stage('refine_data') as stage:
+            refined_data = refine_data(raw_data, subject_mapping)
+            stage.add_rows(len(refined_data))
     logger.info('CSV file successfully loaded')
 
-    schools_data = extract_school_data(refined_data)
-    logger.info('Successfully extracted school data.')
+    report.details['csv_layout'] = raw_data.layout.name if raw_data.layout else None
 
-    scores_data = extract_scores_data(refined_data)
-    logger.info('Successfully extracted scores data.')
+    return _extract(raw_data, refined_data, report)
 
-    db = get_db_engine()
+
+def _write_refined(db: Engine, examination_type: str, grade: int, year: int, refined: RefinedFile, to_import, load_mode: str, place_resolver: PlaceResolver, report: ImportReport, plan_file: str = None):
+    """
+    Writes into the database the data returned by refine_file().
+
+    In dry-run mode the scores are not checked row by row, instead they
+    are compared with all scores of the examination loaded with one query,
+    check change_plan.py. All changes are written in the plan_file when it
+    is specified.
+    """
 
     if 'schools' in to_import:
-        schools_ops_count = _import_schools(db, schools_data)
+        with report.stage('import_schools') as stage:
+            schools_ops_count = _import_schools(db, refined.schools, place_resolver)
+            stage.add_rows(refined.school_rows)
         logger.info('Operations over school: %s', schools_ops_count)
+        refined.failed_rows += schools_ops_count.get(ImportAction.Failed, 0)
 
     if 'scores' in to_import:
-        scores_ops_count = _import_scores(db, examination_type, year, grade, scores_data)
+        with report.stage('import_scores') as stage:
+            max_possible_score = refined.scores['max_possible_score'].max()
+            exam_id = _import_examination(db, examination_type, year, grade, max_possible_score)
+            if is_dry_run():
+                plan = _new_scores_plan(db, exam_id)
+                _plan_scores(db, plan, refined, to_import)
+                scores_ops_count = _finish_scores_plan(plan, plan_file)
+            else:
+                scores_ops_count = _import_scores(db, exam_id, refined.scores, load_mode)
+            stage.add_rows(refined.score_rows)
         logger.info('Operations over examination_score: %s', scores_ops_count)
+        refined.failed_rows += scores_ops_count.get(ImportAction.Failed, 0)
+
+    report.details['failed_rows'] = refined.failed_rows
+
+
+def _refined_chunks(csv_file: str, subject_mapping: dict, chunk_size: int, report: ImportReport) -> Iterator[RefinedFile]:
+    """
+    Yields one RefinedFile per chunk of chunk_size rows of the CSV file.
+    """
+    with _open_refined_csv(csv_file, report) as raw_data:
+        report.details['csv_layout'] = raw_data.layout.name if raw_data.layout else None
+        refined_chunks = refine_data_chunks(raw_data, subject_mapping, chunk_size)
+        while True:
+            with report.stage('refine_data') as stage:
+                refined_chunk = next(refined_chunks, None)
+                if refined_chunk is not None:
+                    stage.add_rows(len(refined_chunk))
+
+            if refined_chunk is None:
+                break
+
+            yield _extract(raw_data, refined_chunk, report)
+
+
+def _import_file_chunks(csv_file: str, examination_type: str, grade: int, year: int, to_import, load_mode: str, place_resolver: PlaceResolver, chunk_size: int, subject_mapping: dict, report: ImportReport, plan_file: str = None) -> RefinedFile:
+    """
+    The streaming variant of import_file(). The schools and the scores of
+    each chunk are written into the DB before the next chunk is read.
+
+    The scores reference the examination, so it is inserted before the
+    scores of the first chunk with scores. The max possible score is
+    inferred for each chunk separately, so the examination is updated after
+    the last chunk with the greatest one, as _write_refined() would set it
+    for the whole file.
+
+    A (school, subject) repeated in different chunks is written by each of
+    them, so the last row wins as in import_file(), but the earlier rows
+    are not counted as Skipped.
+
+    In dry-run mode the scores of all chunks are added to one change plan,
+    check _write_refined().
+
+    Returns RefinedFile without the frames, only the total number of rows.
+    """
+
+    db = get_db_engine()
+
+    schools_ops_count = defaultdict(int)
+    scores_ops_count = defaultdict(int)
+    exam_id = None
+    inserted_max_possible_score = None
+    max_possible_score = None
+    plan = None
+    chunks_count = 0
+    total = RefinedFile(None, 0, 0, 0)
+
+    for chunk in _refined_chunks(csv_file, subject_mapping, chunk_size, report):
+        chunks_count += 1
+        logger.verbose_info('Importing chunk %d with %d schools and %d scores', chunks_count, chunk.school_rows, chunk.score_rows)
+
+        total.layout = chunk.layout
+        total.csv_rows += chunk.csv_rows
+        total.school_rows += chunk.school_rows
+        total.score_rows += chunk.score_rows
+
+        if 'schools' in to_import:
+            with report.stage('import_schools') as stage:
+                _add_ops_count(schools_ops_count, _import_schools(db, chunk.schools, place_resolver))
+                stage.add_rows(chunk.school_rows)
+
+        if 'scores' in to_import and chunk.score_rows > 0:
+            with report.stage('import_scores') as stage:
+                chunk_max_possible_score = chunk.scores['max_possible_score'].max()
+                if max_possible_score is None or chunk_max_possible_score > max_possible_score:
+                    max_possible_score = chunk_max_possible_score
+                if exam_id is None:
+                    inserted_max_possible_score = max_possible_score
+                    exam_id = _import_examination(db, examination_type, year, grade, max_possible_score)
+
+                if is_dry_run():
+                    if plan is None:
+                        plan = _new_scores_plan(db, exam_id)
+                    _plan_scores(db, plan, chunk, to_import)
+                else:
+                    _add_ops_count(scores_ops_count, _import_scores(db, exam_id, chunk.scores, load_mode))
+                stage.add_rows(chunk.score_rows)
+
+    if exam_id is not None and max_possible_score > inserted_max_possible_score:
+        logger.info('Updating the max possible score of examination %s to %s', exam_id, max_possible_score)
+        _import_examination(db, examination_type, year, grade, max_possible_score)
+
+    logger.info('CSV file successfully imported in %d chunks', chunks_count)
+
+    if 'schools' in to_import:
+        logger.info('Operations over school: %s', dict(schools_ops_count))
+
+    if plan is not None:
+        scores_ops_count = _finish_scores_plan(plan, plan_file)
+
+    if 'scores' in to_import:
+        logger.info('Operations over examination_score: %s', dict(scores_ops_count))
+
+    total.failed_rows = schools_ops_count.get(ImportAction.Failed, 0) + scores_ops_count.get(ImportAction.Failed, 0)
+    report.details['failed_rows'] = total.failed_rows
+
+    return total
+
+
+@dataclass
+class BatchItem:
+    """
+    One line of the manifest used by import_batch().
+    """
+    name: str
+    examination_type: str
+    year: int
+    grade: int
+    csv_file: str
+
+
+def read_manifest(manifest_file: str) -> list[BatchItem]:
+    """
+    Reads the manifest for import_batch(). It is a CSV file without header,
+    similar to new_sources.csv, but each line has the columns:
+
+        name,year,grade,path
+
+    The name starts with the examination type, e.g. nvo-4-2019 or dzi-2023.
+    Relative paths are relative to the directory of the manifest.
+    The empty lines and the lines starting with # are skipped.
+    """
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    items = []
+    with open(manifest_file, 'rt', newline='') as f:
+        for line_no, row in enumerate(csv.reader(f), start=1):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+
+            if len(row) != 4:
+                raise ValueError(f'Line {line_no} of manifest {manifest_file} should have 4 columns: name,year,grade,path')
+
+            name, year, grade, path = [v.strip() for v in row]
+            examination_type = name.split('-')[0]
+            csv_file = os.path.join(manifest_dir, path)
+            items.append(BatchItem(name, examination_type, int(year), int(grade), csv_file))
+
+    return items
+
+
+def _init_batch_worker(verbose: bool):
+    if verbose:
+        enable_verbose_logging()
+
+
+def _refine_batch_item(item: BatchItem, subject_mapping: dict) -> tuple[RefinedFile, ImportReport]:
+    """
+    Returns the refined file and the report of the refine stages.
+    """
+    logger.info('Refining %s from file %s', item.name, item.csv_file)
+    report = ImportReport(item.csv_file)
+    refined = refine_file(item.csv_file, subject_mapping, report)
+
+    return refined, report
+
+
+def import_batch(manifest_file: str, to_import=SUPPORTED_IMPORT_CSV_TYPES, load_mode: str = 'upsert', max_workers: int = None, force: bool = False, metrics_file: str = None) -> list[dict]:
+    """
+    Imports all CSV files listed in the manifest, check read_manifest().
+
+    The files are refined in parallel by a pool of max_workers processes,
+    by default one per CPU. The refined data is written into the database
+    only by the current process, file by file in the order of the manifest,
+    while the rest of the files are still being refined.
+
+    As in import_file(), the already imported files are skipped unless
+    force is True, and the reports of all files are returned.
+    """
+
+    items = read_manifest(manifest_file)
+    for item in items:
+        _validate_args(item.csv_file, item.examination_type, item.grade, item.year, load_mode)
+
+    logger.info('Importing %d files from manifest %s', len(items), manifest_file)
+    db = get_db_engine()
+
+    results = []
+    # the manifest names are not unique, e.g. one examination could have
+    # several files, so each item is kept together with its report and digest
+    to_refine = []
+    for item in items:
+        exam_id = get_examination_id(item.examination_type, item.year, item.grade)
+        report = ImportReport(item.csv_file, {'examination_id': exam_id, 'load_mode': load_mode})
+        with report.stage('digest'):
+            digest = file_digest(item.csv_file)
+        report.details['file_digest'] = digest
+
+        if not force and _is_file_imported(db, digest, exam_id, to_import):
+            logger.info('File %s with digest %s is already imported for examination %s, skipping it', item.csv_file, digest, exam_id)
+            report.details['skipped'] = True
+            results.append(report.emit(metrics_file))
+        else:
+            to_refine.append((item, report, digest))
+
+    subject_mapping = load_subject_abbr_map()
+    place_resolver = get_place_resolver() if 'schools' in to_import else None
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker, initargs=(is_verbose(),)) as executor:
+        # popped one by one, so the refined data of the written files is released
+        pending = [
+            (item, report, digest, executor.submit(_refine_batch_item, item, subject_mapping))
+            for item, report, digest in reversed(to_refine)
+        ]
+        try:
+            while pending:
+                item, report, digest, future = pending.pop()
+                refined, refine_report = future.result()
+                report.merge(refine_report)
+
+                logger.info('Writing %s', item.name)
+                _write_refined(db, item.examination_type, item.grade, item.year, refined, to_import, load_mode, place_resolver, report)
+                result = report.emit(metrics_file)
+                _log_import(db, digest, report.details['examination_id'], to_import, refined, result['duration'])
+                results.append(result)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    return results
@@ -0,0 +1,171 @@
+"""
+Per-stage timing and memory report of an import, check import_file() in
+import_csv.py.
+
+Each stage of the import (load, refine, import of schools, etc.) is
+measured with ImportReport.stage(). For each stage the report contains:
+* duration - wall time in seconds
+* rows and rows_per_second - the number of processed rows, when it is known
+* peak_rss_mb and peak_rss_delta_mb - the peak resident memory of the
+  process after the stage and how much it grew during the stage
+* tracemalloc_peak_mb - the peak of the memory allocated during the
+  stage, it is measured only when METRICS_TRACEMALLOC=yes, because
+  tracemalloc slows down the import
+
+When the same stage is measured several times, e.g. once per chunk, the
+durations and the rows are summed.
+
+The report is logged as one JSON line and optionally written to a file.
+"""
+
+import json
+import time
+import os
+import tracemalloc
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Any, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from .runtime import getLogger
+
+
+logger = getLogger(__name__)
+
+
+def _is_tracemalloc_enabled() -> bool:
+    return os.environ.get('METRICS_TRACEMALLOC', 'no') == 'yes'
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _round(value: Any) -> Any:
+    return round(value, 3) if isinstance(value, float) else value
+
+
+@dataclass
+class StageMetrics:
+    name: str
+    duration: float = 0.0
+    rows: Optional[int] = None
+    peak_rss_mb: Optional[float] = None
+    peak_rss_delta_mb: Optional[float] = None
+    tracemalloc_peak_mb: Optional[float] = None
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        if self.rows is None or not self.duration:
+            return None
+        return self.rows / self.duration
+
+    def add_rows(self, rows: int):
+        self.rows = (self.rows or 0) + rows
+
+    def add(self, other: 'StageMetrics'):
+        """
+        Adds the measurements of the same stage made at another time, as
+        ImportReport.stage() does for a stage measured several times.
+        """
+        self.duration += other.duration
+        if other.rows is not None:
+            self.add_rows(other.rows)
+        if other.peak_rss_mb is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0, other.peak_rss_mb)
+        if other.peak_rss_delta_mb is not None:
+            self.peak_rss_delta_mb = (self.peak_rss_delta_mb or 0) + other.peak_rss_delta_mb
+        if other.tracemalloc_peak_mb is not None:
+            self.tracemalloc_peak_mb = max(self.tracemalloc_peak_mb or 0, other.tracemalloc_peak_mb)
+
+    def as_dict(self) -> dict[str, Any]:
+        result = {**asdict(self), 'rows_per_second': self.rows_per_second}
+        return {k: _round(v) for k, v in result.items()}
+
+
+@dataclass
+class ImportReport:
+    """
+    The `name` is usually the path to the imported file, the `details`
+    contain any other information, e.g. the examination id.
+    """
+    name: str
+    details: dict[str, Any] = field(default_factory=dict)
+    stages: dict[str, StageMetrics] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the code in the with block as stage with that name.
+        Yields StageMetrics, the rows should be added with add_rows().
+        """
+        metrics = self.stages.setdefault(name, StageMetrics(name))
+
+        trace = _is_tracemalloc_enabled()
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_before, _ = tracemalloc.get_traced_memory()
+
+        rss_before = _peak_rss_mb()
+        started = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.duration += time.perf_counter() - started
+
+            rss_after = _peak_rss_mb()
+            if rss_after is not None:
+                metrics.peak_rss_mb = rss_after
+                metrics.peak_rss_delta_mb = (metrics.peak_rss_delta_mb or 0) + rss_after - rss_before
+
+            if trace:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                peak_mb = (traced_peak - traced_before) / (1024 * 1024)
+                metrics.tracemalloc_peak_mb = max(metrics.tracemalloc_peak_mb or 0, peak_mb)
+
+    def merge(self, other: 'ImportReport'):
+        """
+        Adds the stages of other report, e.g. the one made by another process.
+        The stages found in both reports are summed, as the stages measured
+        several times.
+        """
+        self.details.update(other.details)
+        for name, metrics in other.stages.items():
+            if name in self.stages:
+                self.stages[name].add(metrics)
+            else:
+                self.stages[name] = metrics
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'name': self.name,
+            **self.details,
+            'duration': _round(sum(s.duration for s in self.stages.values())),
+            'stages': [s.as_dict() for s in self.stages.values()],
+        }
+
+    def emit(self, metrics_file: str = None) -> dict[str, Any]:
+        """
+        Logs the report as one JSON line and appends it to the metrics_file
+        when specified. Returns the report as dictionary.
+        """
+        report = self.as_dict()
+        line = json.dumps(report, ensure_ascii=False)
+        logger.info('Import report: %s', line)
+
+        if metrics_file:
+            with open(metrics_file, 'at') as f:
+                f.write(line + '\n')
+
+        return report
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 # Constant used for working with bulgarian schools in foreign countries.
 FOREIGN_COUNTRY = 'Чужбина'
@@ -102,3 +103,46 @@ def get_default_subjects() -> list[SubjectItem]:
     ]
 
     return default_subject_items
+
+
+@dataclass
+class PlaceAlias:
+    """
+    Some regions, municipalities and places are named differently in the
+    CSV files and in wikidata (where the database records come from).
+    For example the region София-град in the CSV files is София Столица
+    in wikidata.
+
+    Each PlaceAlias describes one such difference:
+    * `column` is one of 'region', 'municipality' or 'place'
+    * `value` is the name found in the CSV files
+    * `replacement` is the name in the database
+    * `place` is optional, when it is set the alias is applied only
+      for this place. This is needed because there are villages which belong
+      to a municipality with different name than the one in the CSV files.
+
+    All comparisons are case insensitive.
+
+    The aliases are applied by the PlaceResolver in the order returned by
+    get_default_place_aliases().
+    """
+    column: str
+    value: str
+    replacement: str
+    place: Optional[str] = None
+
+    def matches(self, value: str, place: str) -> bool:
+        if self.value.lower() != value.lower():
+            return False
+
+        return self.place is None or self.place.lower() == place.lower()
+
+
+def get_default_place_aliases() -> list[PlaceAlias]:
+    return [
+        PlaceAlias(column='region', value='София-град', replacement='София Столица'),
+        PlaceAlias(column='region', value='София-област', replacement='София'),
+        PlaceAlias(column='municipality', value='Столична', replacement='Столична община'),
+        PlaceAlias(column='municipality', value='гр.Добрич', replacement='Добрич'),
+        PlaceAlias(column='municipality', value='Добрич', replacement='Добрич-селска', place='Карапелит'),
+    ]
@@ -0,0 +1,121 @@
+"""
+This module provides the PlaceResolver class which finds the database
+place (city or village) of a school described in NVO or DZI CSV file
+by the names of its place, municipality and region.
+"""
+
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .db_models import Place, Municipality, Region
+from .models import PlaceAlias, get_default_place_aliases
+from .runtime import getLogger
+
+
+logger = getLogger(__name__)
+
+
+# The prefixes of the place names found in the CSV files, the database
+# contains the names without them.
+PLACE_PREFIXES = ('с.', 'гр.')
+
+
+class PlaceResolver:
+    """
+    Index of all places in the database by their lowercased
+    (region, municipality, place) names.
+
+    The index is loaded with one query on the first call of find(), after
+    that all lookups are done in memory. Before the lookup the CSV names
+    are standardized with the place aliases, check the PlaceAlias docs.
+
+    Use get_place_resolver() to get the resolver shared by all imports
+    in the current process.
+    """
+
+    def __init__(self, aliases: Optional[list[PlaceAlias]] = None):
+        self._aliases = get_default_place_aliases() if aliases is None else aliases
+        self._index: Optional[dict[tuple[str, str, str], str]] = None
+
+    def _load(self, session: Session):
+        stmt = (
+            select(Place.c.id, Place.c.name, Municipality.c.name, Region.c.name).
+            select_from(
+                Place
+                .join(Municipality, Place.c.municipality_id == Municipality.c.id)
+                .join(Region, Municipality.c.region_id == Region.c.id)
+            ).
+            order_by(Place.c.id)
+        )
+
+        self._index = {}
+        for place_id, place_name, mun, region in session.execute(stmt):
+            self._index.setdefault(self._key(place_name, mun, region), place_id)
+
+        logger.info('Loaded %d places', len(self._index))
+
+    @staticmethod
+    def _key(place_name: str, mun: str, region: str) -> tuple[str, str, str]:
+        return (region or '').lower(), (mun or '').lower(), (place_name or '').lower()
+
+    def standardize(self, place_name: str, mun: str, region: str) -> tuple[str, str, str]:
+        """
+        Returns the (place_name, mun, region) names as they are expected to
+        be found in the database.
+        """
+        for prefix in PLACE_PREFIXES:
+            if place_name.startswith(prefix):
+                place_name = place_name[len(prefix):].strip()
+
+        for alias in self._aliases:
+            if alias.column == 'region' and alias.matches(region, place_name):
+                region = alias.replacement
+            elif alias.column == 'municipality' and alias.matches(mun, place_name):
+                mun = alias.replacement
+            elif alias.column == 'place' and alias.matches(place_name, place_name):
+                place_name = alias.replacement
+
+        return place_name, mun, region
+
+    def find(self, session: Session, place_name: str, mun: str, region: str) -> Optional[str]:
+        """
+        Returns the id of the place or None if it is not found.
+        """
+        if self._index is None:
+            self._load(session)
+
+        place_name, mun, region = self.standardize(place_name, mun, region)
+
+        place_id = self._index.get(self._key(place_name, mun, region))
+        if place_id:
+            logger.verbose_info('Found place: (%s, %s, %s) with id %s', place_name, mun, region, place_id)
+        else:
+            logger.verbose_info('Did not find place: (%s, %s, %s)', place_name, mun, region)
+
+        return place_id
+
+    def add(self, place_id: str, place_name: str, mun: str, region: str):
+        """
+        Adds place inserted during the import to the index.
+        """
+        if self._index is not None:
+            place_name, mun, region = self.standardize(place_name, mun, region)
+            self._index[self._key(place_name, mun, region)] = place_id
+
+    def reset(self):
+        """
+        Drops the index, it will be loaded again on the next find().
+        """
+        self._index = None
+
+
+_place_resolver = PlaceResolver()
+
+
+def get_place_resolver() -> PlaceResolver:
+    """
+    Returns the PlaceResolver shared by all imports in the current process.
+    """
+    return _place_resolver
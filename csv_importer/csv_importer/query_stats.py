@@ -0,0 +1,170 @@
+"""
+Opt-in instrumentation of the SQL statements executed through the engine
+returned by get_db_engine(). It is enabled with DB_QUERY_STATS=yes.
+
+The statements are grouped by their normalized shape - the bound
+parameters and the literals are replaced with `?`, and the repeated
+parameters of multi-row INSERT and IN lists are collapsed. For each shape
+are counted the executions and their total duration.
+
+Shapes executed as separate statements at least N_PLUS_ONE_THRESHOLD
+times are reported as possible N+1 patterns, i.e. queries executed once
+per row in a loop, which should be replaced by one query for all rows.
+The reports contain the place in the csv_importer code where the shape was
+executed for the first time.
+
+The summary is logged with log_query_stats() at the end of every CLI and
+DAG command.
+"""
+
+import os
+import re
+import threading
+import time
+import traceback
+
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .runtime import getLogger
+
+
+logger = getLogger(__name__)
+
+
+N_PLUS_ONE_THRESHOLD = 100
+
+# The number of shapes in the summary, the rest are only counted.
+SUMMARY_SIZE = 20
+
+_SHAPE_MAX_LENGTH = 120
+
+_NORMALIZATIONS = [
+    # bound parameters of psycopg2 - %(name)s, and of sqlite - ?
+    (re.compile(r'%\(\w+\)s'), '?'),
+    # string and number literals
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    # repeated rows of multi-row INSERT
+    (re.compile(r'(\([?,\s]+\))(?:\s*,\s*\([?,\s]+\))+'), r'\1, ...'),
+    # IN lists and the rows above
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?, ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+@dataclass
+class ShapeStats:
+    shape: str
+    count: int = 0
+    duration: float = 0.0
+    executemany: bool = False
+    caller: Optional[str] = None
+
+    @property
+    def is_n_plus_one(self) -> bool:
+        return not self.executemany and self.count >= N_PLUS_ONE_THRESHOLD
+
+
+_stats: dict[str, ShapeStats] = {}
+_lock = threading.Lock()
+
+
+def is_query_stats_enabled() -> bool:
+    return os.environ.get('DB_QUERY_STATS', 'no') == 'yes'
+
+
+def normalize_statement(statement: str) -> str:
+    shape = statement.strip()
+    for regex, replacement in _NORMALIZATIONS:
+        shape = regex.sub(replacement, shape)
+
+    return shape
+
+
+def _find_caller() -> Optional[str]:
+    """
+    Returns the innermost frame of the csv_importer package, except this
+    module, which led to the statement execution.
+    """
+    package_dir = os.path.dirname(__file__)
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(package_dir) and frame.filename != __file__:
+            return f'{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}()'
+
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_stats_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_stats_started'].pop()
+    shape = normalize_statement(statement)
+
+    with _lock:
+        stats = _stats.get(shape)
+        if stats is None:
+            stats = _stats[shape] = ShapeStats(shape, caller=_find_caller())
+
+        stats.count += 1
+        stats.duration += duration
+        stats.executemany = stats.executemany or executemany
+
+
+def instrument_engine(engine: Engine):
+    """
+    Attaches the listeners which collect the statistics to the engine.
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    logger.info('SQL query statistics are enabled')
+
+
+def get_query_stats() -> list[ShapeStats]:
+    """
+    Returns the statistics of all shapes, the slowest first.
+    """
+    with _lock:
+        return sorted(_stats.values(), key=lambda s: s.duration, reverse=True)
+
+
+def reset_query_stats():
+    with _lock:
+        _stats.clear()
+
+
+def log_query_stats():
+    """
+    Logs summary table with the slowest shapes and warnings for the
+    possible N+1 patterns. Does nothing when the statistics are not enabled.
+    """
+    if not is_query_stats_enabled():
+        return
+
+    all_stats = get_query_stats()
+    total_count = sum(s.count for s in all_stats)
+    total_duration = sum(s.duration for s in all_stats)
+    logger.info(
+        'SQL query statistics: %d statements of %d shapes, %.3fs in total',
+        total_count, len(all_stats), total_duration
+    )
+
+    logger.info('%8s %10s %10s  %s', 'count', 'total ms', 'mean ms', 'shape')
+    for stats in all_stats[:SUMMARY_SIZE]:
+        logger.info(
+            '%8d %10.1f %10.3f  %s',
+            stats.count, stats.duration * 1000, stats.duration * 1000 / stats.count,
+            stats.shape[:_SHAPE_MAX_LENGTH]
+        )
+
+    for stats in all_stats:
+        if stats.is_n_plus_one:
+            logger.warning(
+                'Possible N+1 pattern, executed %d times from %s: %s',
+                stats.count, stats.caller, stats.shape[:_SHAPE_MAX_LENGTH]
+            )
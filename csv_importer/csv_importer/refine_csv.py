@@ -11,18 +11,25 @@ It can be used as a standalone app by passing one CSV file to it. This is
 dev use case - it calls all main functions on the provided CSV file.
 """
 
+import numpy as np
 import pandas as pd
 import sys
 import logging
 import os
 import re
+import tempfile
 
-from io import StringIO
+from contextlib import contextmanager
+from functools import lru_cache
+from io import RawIOBase, StringIO, TextIOBase, TextIOWrapper, UnsupportedOperation
+from itertools import chain
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, TextIO, Union
 
 
-from .runtime import getLogger
+from .runtime import getLogger, is_verbose
 from .db_manage import load_subject_abbr_map
 from .models import SubjectItem
+from .csv_layouts import CsvLayout, KNOWN_LAYOUTS, header_fingerprint
 
 
 logger = getLogger(__name__)
@@ -79,45 +86,83 @@ SBJ_IDX = 0
 ATTR_IDX = 1
 
 
-def refine_original_col_name(value: str) -> str:
+# The rules above compiled once. The special position rules are compiled as
+# pairs of regular expressions - for the beginning and for the end of the
+# column name.
+_COMPILED_COL_RE_TRANSLATION = [
+    (regex, re.compile(regex), repl)
+    for regex, repl in COL_RE_TRANSLATION
+]
+_COMPILED_COL_RE_TRANSLATION_SPECIAL_POSITIONS = [
+    (base_regex, re.compile(f'^{base_regex}'), re.compile(f'{base_regex}$'), repl)
+    for base_regex, repl in COL_RE_TRANSLATION_SPECIAL_POSITIONS
+]
+
+# The number of translated column names kept by refine_original_col_name.
+# The cache is shared by all files refined in the current process.
+COL_NAME_CACHE_SIZE = 4096
+
+
+def _translate_col_name(value: str, trace: Optional[list[tuple[str, str, str]]] = None) -> str:
     """
-    This function changes original column names.
-    * translates known texts from Bulgarian to English
-    * lowers all letters
-    * removes redundant information or characters
+    Implements refine_original_col_name(). When trace list is provided,
+    for every rule which changed the value a tuple (rule, before, after)
+    is appended to it.
     """
 
-    logger.verbose_info('value %s', value)
-
-    value = value.replace('"', '')
-    value = value.lower()
-    logger.verbose_info('value %s', value)
+    def _apply(rule: str, before: str, after: str) -> str:
+        if trace is not None and before != after:
+            trace.append((rule, before, after))
+        return after
 
-    while '  ' in value:
-        value = value.replace('  ', ' ')
-    logger.verbose_info('value %s', value)
+    value = _apply('remove quotes', value, value.replace('"', ''))
+    value = _apply('lower', value, value.lower())
 
+    collapsed = value
+    while '  ' in collapsed:
+        collapsed = collapsed.replace('  ', ' ')
+    value = _apply('collapse spaces', value, collapsed)
 
-    for regex, repl in COL_RE_TRANSLATION:
-        value = re.sub(regex, repl, value)
-        value = value.strip()
-    logger.verbose_info('value %s', value)
+    for regex, compiled, repl in _COMPILED_COL_RE_TRANSLATION:
+        value = _apply(regex, value, compiled.sub(repl, value).strip())
 
-    for base_regex, repl in COL_RE_TRANSLATION_SPECIAL_POSITIONS:
-        value = re.sub(f'^{base_regex}', repl, value)
-        value = re.sub(f'{base_regex}$', repl, value)
-        value = value.strip()
-    logger.verbose_info('value %s', value)
+    for base_regex, at_start, at_end, repl in _COMPILED_COL_RE_TRANSLATION_SPECIAL_POSITIONS:
+        value = _apply(f'^{base_regex}', value, at_start.sub(repl, value))
+        value = _apply(f'{base_regex}$', value, at_end.sub(repl, value).strip())
 
     # sometimes there's missing space between the subject name and
     # the score
     if 'score' in value and not value.startswith('score') and ' score' not in value:
-        value = value.replace('score', ' score')
-    logger.verbose_info('value %s', value)
+        value = _apply('space before score', value, value.replace('score', ' score'))
 
     return value
 
 
+@lru_cache(maxsize=COL_NAME_CACHE_SIZE)
+def refine_original_col_name(value: str) -> str:
+    """
+    This function changes original column names.
+    * translates known texts from Bulgarian to English
+    * lowers all letters
+    * removes redundant information or characters
+
+    The results are memoized, check COL_NAME_CACHE_SIZE.
+    Use explain_col_name() to find out which rules changed given name.
+    """
+    return _translate_col_name(value)
+
+
+def explain_col_name(value: str) -> list[tuple[str, str, str]]:
+    """
+    Returns the rules applied by refine_original_col_name() on the value
+    as list of tuples (rule, before, after). Only the rules which changed
+    the value are listed.
+    """
+    trace = []
+    _translate_col_name(value, trace)
+    return trace
+
+
 def order_attr_in_subject_column_names(col_names):
     """
     This function re-orders the words in column names like
@@ -191,40 +236,176 @@ def infer_max_possible_nvo_score(data: pd.DataFrame) -> float:
     return 100.00
 
 
-def load_csv(file: str) -> StringIO:
+def _max_possible_nvo_scores(max_scores: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of infer_max_possible_nvo_score(), it takes the
+    max score of each subject and returns the max possible score for it.
+    """
+    logger.verbose_info('max score values calculated are: %s', max_scores)
+
+    return np.select(
+        [max_scores <= 6.00, max_scores <= 65.00],
+        [6.00, 65.00],
+        100.00
+    )
+
+
+# The first unicode sequence is the BOM mark,
+# The second one is another weird unicode sequence found in a column name.
+# The third item is because one of the files contains: "<BOM>""Област"""
+#   So the <BOM> will be replaced, then we handle the tripled quotes
+#   It is handled by this special way, because it is not good idea to handle
+#   tripled quotes in the whole file.
+_LINE_REPLACEMENTS = {
+    '\ufeff': '',
+    '\u00a0': '',
+    '"""Област"""': '"Област"'
+}
+
+# The size of the read buffer used for the CSV files.
+_READ_BUFFER_SIZE = 1 << 20
+
+
+class LinesReader(TextIOBase):
+    """
+    Read-only text stream over an iterator of lines.
+
+    It is used to pass the cleaned and refined CSV lines to pandas.read_csv
+    without copying the whole file into intermediate buffers - the lines
+    are pulled from the iterator only when pandas reads them.
+
+    The stream can be read only once, seek(0) is supported only before
+    the first read. This way it can be passed to functions which rewind
+    their StringIO input.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self._lines = iter(lines)
+        self._buffer = ''
+        self._started = False
+
+    def readable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset == 0 and whence == 0 and not self._started:
+            return 0
+        raise UnsupportedOperation('LinesReader can be read only once.')
+
+    def read(self, size: int = -1) -> str:
+        self._started = True
+
+        if size is None or size < 0:
+            result = self._buffer + ''.join(self._lines)
+            self._buffer = ''
+            return result
+
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+
+        data = ''.join(parts)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size: int = -1) -> str:
+        self._started = True
+
+        if self._buffer:
+            if '\n' in self._buffer:
+                line, self._buffer = self._buffer.split('\n', 1)
+                return line + '\n'
+            line = self._buffer + next(self._lines, '')
+            self._buffer = ''
+            return line
+
+        return next(self._lines, '')
+
+    def __next__(self) -> str:
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def _clean_lines(f: BinaryIO) -> Iterator[str]:
+    """
+    Decodes the lines of a raw CSV file and applies the _LINE_REPLACEMENTS.
+    """
     # using 'utf-8-sig' encoding to handle the BOM csv files provided
     # by data.egov.bg
     # Some of the CSV files contain the BOM mark not only at the beginning
     # of the file, but also inside the first value on the first line.
-    # That's why below we replace the sequence '\ufeff' everywhere.
+    # That's why the sequence '\ufeff' is replaced everywhere.
     # https://en.wikipedia.org/wiki/Byte_order_mark
     # https://docs.python.org/3/howto/unicode.html
     # https://stackoverflow.com/questions/13590749/reading-unicode-file-data-with-bom-chars-in-python
+    for line in f:
+        line = line.decode('utf-8-sig')
+        for old_v, new_v in _LINE_REPLACEMENTS.items():
+            if old_v in line:
+                line = line.replace(old_v, new_v)
 
-    # The first unicode sequence is the BOM mark,
-    # The second one is another weird unicode sequence found in a column name.
-    # The third item is because one of the files contains: "<BOM>""Област"""
-    #   So the <BOM> will be replaced, then we handle the tripled quotes
-    #   It is handled by this special way, because it is not good idea to handle
-    #   tripled quotes in the whole file.
-    to_replace = {
-        '\ufeff': '',
-        '\u00a0': '',
-        '"""Област"""': '"Област"'
-    }
+        yield line
 
-    result = StringIO()
-    with open(file, 'rb') as f:
-        for line in f:
-            line = line.decode('utf-8-sig')
-            for old_v, new_v in to_replace.items():
-                line = line.replace(old_v, new_v)
 
+@contextmanager
+def open_csv(file: str) -> Iterator[LinesReader]:
+    """
+    Opens a raw NVO or DZI CSV file for streaming reading. The lines are
+    cleaned the same way as in load_csv(), but one at a time while they
+    are read.
+
+    Usage:
+        with open_csv(csv_file) as raw_data:
+            raw_data = refine_csv_column_names(raw_data)
+            refined_data = refine_data(raw_data, subject_mapping)
+    """
+    with open(file, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        yield LinesReader(_clean_lines(f))
+
+
+def load_csv(file: str) -> StringIO:
+    """
+    Loads the whole raw CSV file into StringIO, check _clean_lines().
+    Prefer open_csv() which does not keep the file in memory.
+    """
+    result = StringIO()
+    with open(file, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        for line in _clean_lines(f):
             result.write(line)
 
     return result
 
 
+# Registry of the known CSV header layouts by their fingerprint, check
+# csv_layouts.py. The layouts of unknown headers are added to it when they
+# are refined for the first time, so the heuristics in
+# refine_csv_column_names() run once per layout in the current process.
+_layouts_by_fingerprint: dict[str, CsvLayout] = {
+    layout.fingerprint: layout
+    for layout in KNOWN_LAYOUTS
+}
+
+
+def get_layout(fingerprint: str) -> Optional[CsvLayout]:
+    return _layouts_by_fingerprint.get(fingerprint)
+
+
+def register_layout(layout: CsvLayout):
+    _layouts_by_fingerprint.setdefault(layout.fingerprint, layout)
+
+
+def _rewind(input: Union[TextIO, Iterable[str]]):
+    if hasattr(input, 'seekable') and input.seekable():
+        input.seek(0)
+
+
 def fill_empty_cells_from_previous(input: list[str]) -> list[str]:
     """
     Takes a list of strings as input and returns another list in which the
@@ -250,7 +431,65 @@ def fill_empty_cells_from_previous(input: list[str]) -> list[str]:
     return result
 
 
-def refine_csv_column_names(input: StringIO) -> StringIO:
+def _plan_column_names(column_names_line: str, column_option_lines: list[str]) -> list[str]:
+    """
+    Implements the heuristics of refine_csv_column_names() which build the
+    refined column names from the original column names line and the lines
+    with column options.
+    """
+
+    # get the original column lines, remove the double quotes
+    new_col_names = [
+        c.replace('"', '')
+        for c in column_names_line.split(',')
+    ]
+    logger.verbose_info('new_col_names: %s', new_col_names)
+
+    # In some files there are columns without name. These columns take
+    # the name of the previous column.
+    new_col_names = fill_empty_cells_from_previous(new_col_names)
+    logger.verbose_info('new_col_names: %s', new_col_names)
+
+    # Merge the new column names with the values of the lines with column
+    # options
+    for option_line in column_option_lines:
+        options = [
+            c.replace('"', '')
+            for c in option_line.split(',')
+        ]
+        logger.verbose_info('options: %s', options)
+        options = fill_empty_cells_from_previous(options)
+        logger.verbose_info('options: %s', options)
+
+        # merge new_col_names with the current options and produce
+        # list with the merged values
+        ex_col_names = []
+        for col_name, option in zip(new_col_names, options):
+            # strip is important for the empty options
+            new_col_name = f'{col_name} {option}'.strip()
+            ex_col_names.append(new_col_name)
+        new_col_names = ex_col_names
+
+        logger.verbose_info('options: %s', options)
+        logger.verbose_info('new_col_names: %s', new_col_names)
+
+    # translate  columns
+    if is_verbose():
+        for col_name in new_col_names:
+            for rule, before, after in explain_col_name(col_name):
+                logger.verbose_info('column %s: rule %s changed %s to %s', col_name, rule, before, after)
+
+    new_col_names = [refine_original_col_name(c) for c in new_col_names]
+    logger.verbose_info('new_col_names: %s', new_col_names)
+
+    # organize all subject column names to contain subject at the beginning
+    new_col_names = order_attr_in_subject_column_names(new_col_names)
+    logger.verbose_info('new_col_names: %s', new_col_names)
+
+    return new_col_names
+
+
+def refine_csv_column_names(input: Union[TextIO, Iterable[str]]) -> LinesReader:
     """
     The function gets the raw CSV input removes all non-CSV lines and
     more importantly - re-organizes the CSV column names in a way which
@@ -344,19 +583,30 @@ def refine_csv_column_names(input: StringIO) -> StringIO:
     we have 'Явили се' columns for all subjects, then 'Среден успех' columns
     for all subjects.
 
-    At the end this function returns the input StringIO changed to contain
-    only one line with column names. This way it is ready to be imported
-    by Pandas.
+    The heuristics above run only for unknown headers. The headers are
+    identified by the fingerprint of the column names line and the column
+    options lines. For the layouts registered in csv_layouts.py the refined
+    column names are taken from the registry. The layout of an unknown
+    header is registered after the heuristics, so the next file with the
+    same header in the current process skips them.
+
+    At the end this function returns stream over the input lines changed
+    to contain only one line with column names. This way it is ready to be
+    imported by Pandas. The input can be StringIO, the stream returned by
+    open_csv() or any other iterable of lines. The lines after the header
+    are not copied, they are read from the input when the result is read.
+    The `layout` attribute of the result is the CsvLayout of the header.
     """
 
-    input.seek(0)
+    _rewind(input)
+    lines = iter(input)
 
     # This loop finds the line with the original column names and
     # also the lines which contain additional column options
     column_names_line = None
     column_option_lines = []
     buffered_line = None
-    for line in input:
+    for line in lines:
         if column_names_line is None:
             if line.startswith('"Област') or line.startswith('"Регион'):
                 column_names_line = line.strip()
@@ -372,88 +622,308 @@ def refine_csv_column_names(input: StringIO) -> StringIO:
         raise RuntimeError('Cannot find line with column names.')
     logger.verbose_info('column_names_line: %s', column_names_line)
 
-    output = StringIO()
-
-    # get the original column lines, remove the double quotes
-    new_col_names = [
-        c.replace('"', '')
-        for c in column_names_line.split(',')
-    ]
+    fingerprint = header_fingerprint([column_names_line, *column_option_lines])
+    layout = get_layout(fingerprint)
+    if layout:
+        logger.info('The CSV header matches known layout %s', layout.name)
+        new_col_names = list(layout.column_names)
+    else:
+        logger.info('The CSV header does not match known layout, its fingerprint is %s', fingerprint)
+        new_col_names = _plan_column_names(column_names_line, column_option_lines)
+        layout = CsvLayout(
+            name=f'unknown-{fingerprint[:12]}',
+            header_lines=(column_names_line, *column_option_lines),
+            column_names=tuple(new_col_names),
+        )
+        register_layout(layout)
     logger.verbose_info('new_col_names: %s', new_col_names)
 
-    # In some files there are columns without name. These columns take
-    # the name of the previous column.
-    new_col_names = fill_empty_cells_from_previous(new_col_names)
-    logger.verbose_info('new_col_names: %s', new_col_names)
+    # construct the new column names line
+    new_column_names_lines = ','.join(new_col_names) + os.linesep
+    logger.verbose_info('new_column_names_lines: %s', new_column_names_lines)
 
-    # Merge the new column names with the values of the lines with column
-    # options
-    for option_line in column_option_lines:
-        options = [
-            c.replace('"', '')
-            for c in option_line.split(',')
-        ]
-        logger.verbose_info('options: %s', options)
-        options = fill_empty_cells_from_previous(options)
-        logger.verbose_info('options: %s', options)
+    head_lines = [new_column_names_lines]
 
-        # merge new_col_names with the current options and produce
-        # list with the merged values
-        ex_col_names = []
-        for col_name, option in zip(new_col_names, options):
-            # strip is important for the empty options
-            new_col_name = f'{col_name} {option}'.strip()
-            ex_col_names.append(new_col_name)
-        new_col_names = ex_col_names
+    if buffered_line:
+        logger.verbose_info('buffered_line: %s', buffered_line)
+        head_lines.append(buffered_line)
 
-        logger.verbose_info('options: %s', options)
-        logger.verbose_info('new_col_names: %s', new_col_names)
+    # all other lines are streamed from the input
+    result = LinesReader(chain(head_lines, lines))
+    result.layout = layout
 
-    # translate  columns
-    for i in range(len(new_col_names)):
-        new_col_names[i] = refine_original_col_name(new_col_names[i])
-    logger.verbose_info('new_col_names: %s', new_col_names)
+    return result
 
-    # organize all subject column names to contain subject at the beginning
-    new_col_names = order_attr_in_subject_column_names(new_col_names)
-    logger.verbose_info('new_col_names: %s', new_col_names)
 
-    # construct the new column names line
-    new_column_names_lines = ','.join(new_col_names) + os.linesep
-    logger.verbose_info('new_column_names_lines: %s', new_column_names_lines)
+# The columns describing the place of the school, they are loaded as
+# categorical, because the same values repeat thousands of times.
+PLACE_COLUMNS = ['region', 'municipality', 'place']
 
-    output.write(new_column_names_lines)
 
-    if buffered_line:
-        logger.verbose_info('buffered_line: %s', buffered_line)
-        output.write(buffered_line)
+# The refined CSV is parsed with pyarrow if it is installed, it is
+# multithreaded and faster than the pandas C engine. pyarrow.csv is used
+# directly, because the pandas pyarrow engine infers the column types
+# before applying the dtypes, so i.e. the school ids become '1000002.0'.
+# pyarrow is stricter than the C engine, e.g. it does not accept rows with
+# fewer columns, such files are parsed again with the C engine, so the
+# result does not depend on whether pyarrow is installed. The CSV is
+# streamed into pyarrow, the lines already read are kept in a temporary
+# file for the C engine, check _SpillingReader.
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+
+def csv_dtypes(column_names: Iterable[str]) -> dict[str, Any]:
+    """
+    Returns the dtypes of the refined CSV columns for pandas.read_csv:
+    * school id and name are strings - the school id is never parsed as
+      float, it is normalized by _refine_school_admin_id()
+    * region, municipality and place are categorical
+    * people columns are floats, because some files contain values like
+      12.0, they are converted to int32 and the missing values to -1 by
+      refine_data()
+    * score columns are strings, because some of the files use decimal
+      comma, they are converted to float by refine_data()
+    """
+    dtypes = {
+        'school_admin_id': str,
+        'school': str,
+    }
+    for c in PLACE_COLUMNS:
+        dtypes[c] = 'category'
+
+    for c in column_names:
+        if is_people_column(c):
+            dtypes[c] = 'float64'
+        elif is_score_column(c):
+            dtypes[c] = str
+
+    return dtypes
+
+
+# the temporary file of _SpillingReader is kept in memory up to this size
+_SPILL_MAX_MEMORY = 16 * 1024 * 1024
+
 
-    # copy add all other lines into the result
-    for line in input:
-        output.write(line)
+class _SpillingReader(RawIOBase):
+    """
+    Binary stream of the UTF-8 encoded lines of a text stream, for pyarrow.
+
+    The lines are read only when pyarrow reads them and they are written
+    in the `spill` temporary file, so after pyarrow fails they could be
+    parsed again without keeping the whole CSV in memory, check
+    remaining_text().
+    """
+
+    def __init__(self, csv_data: TextIO):
+        self._csv_data = csv_data
+        self._buffer = b''
+        self.spill = tempfile.SpooledTemporaryFile(max_size=_SPILL_MAX_MEMORY)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) < len(b):
+            line = self._csv_data.readline()
+            if not line:
+                break
+            data = line.encode('utf-8')
+            self.spill.write(data)
+            self._buffer += data
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
 
-    return output
+    def remaining_text(self) -> TextIO:
+        """
+        Returns text stream with all lines of the CSV - the ones read by
+        pyarrow followed by the rest.
+        """
+        self.spill.seek(0)
+        spilled_lines = TextIOWrapper(self.spill, encoding='utf-8', newline='')
+        return LinesReader(chain(spilled_lines, self._csv_data))
+
+    def close(self):
+        self.spill.close()
+        super().close()
+
+
+def _read_csv_with_pyarrow(csv_data: BinaryIO, column_names: Iterable[str]) -> pd.DataFrame:
+    column_types = {}
+    for c, dtype in csv_dtypes(column_names).items():
+        if dtype == 'category':
+            column_types[c] = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        elif dtype == 'float64':
+            column_types[c] = pyarrow.float64()
+        else:
+            column_types[c] = pyarrow.string()
+
+    table = pyarrow_csv.read_csv(
+        csv_data,
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types=column_types,
+            strings_can_be_null=True
+        )
+    )
 
+    return table.to_pandas()
 
-def refine_data(csv_data: StringIO, subject_mapping: dict[str, SubjectItem]) -> pd.DataFrame:
+
+def read_refined_csv(csv_data: TextIO, column_names: Iterable[str]) -> pd.DataFrame:
+    """
+    Parses the refined CSV with the dtypes from csv_dtypes(). The column_names
+    are the refined column names, i.e. the ones of the CsvLayout.
+    The CSV is read as stream, it is never loaded in memory as a whole.
+    """
+    if pyarrow is None:
+        return pd.read_csv(csv_data, dtype=csv_dtypes(column_names))
+
+    with _SpillingReader(csv_data) as reader:
+        try:
+            return _read_csv_with_pyarrow(reader, column_names)
+        except pyarrow.ArrowInvalid as e:
+            logger.warning('Failed to parse the CSV with pyarrow, parsing it with pandas: %s', e)
+            return pd.read_csv(reader.remaining_text(), dtype=csv_dtypes(column_names))
+
+
+def _map_unique(values: pd.Series, func) -> pd.Series:
+    """
+    Returns the same result as values.apply(func), but func is called only
+    once per distinct value. The missing values are passed to func as well.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    mapped = np.empty(len(uniques), dtype=object)
+    mapped[:] = [func(v) for v in uniques]
+
+    return pd.Series(mapped[codes], index=values.index, name=values.name)
+
+
+def _unify_foreign_country(v: str) -> str:
+    if 'чужбина' in v.lower():
+        return 'Чужбина'
+    else:
+        return v
+
+
+def _pretty_region_or_municipality(value: str) -> str:
+    return _unify_foreign_country(value).title()
+
+
+def _get_pretty_place(value: str) -> str:
+    """
+    Formats cities and villages in standard way.
+    TODO: Some places do not contain `гр.` and `с.` prefixes, as result
+    in the database we have `гр. София` and `София` records.
+    """
+    if not value:
+        return value
+
+    def _upper_first(s: str) -> str:
+        if not s:
+            return s
+
+        s = s.strip()
+        return s[0].upper() + s[1:].lower()
+
+    try:
+        if '.' in value:
+            prefix, name = value.split('.')
+            return f'{prefix.strip().lower()}. {_upper_first(name)}'
+        else:
+            return _upper_first(value.strip())
+    except:
+        logger.error('Failed to make pretty place from value %s', value)
+        raise
+
+
+def _refine_school_admin_id(values: pd.Series) -> pd.Series:
+    """
+    Converts the school id column to str.
+
+    For some CSV files the school ID loads as float, because of missing
+    values, these are converted to integer strings directly,
+    i.e. 1000002.0 becomes '1000002'.
+
+    In some CSV files the school ID contain spaces, in some it does not.
+    For them the spaces are removed. Also '.0' is removed as it was the
+    case with float values converted to str. The leading zeros of the
+    numeric ids are removed too, as it is when the ids are parsed as
+    numbers, i.e. '0100101' becomes '100101'.
+
+    In both cases the missing values become 'nan'.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        try:
+            return values.astype('Int64').astype(str).where(values.notna(), 'nan')
+        except TypeError:
+            # the column contains non integer values, handled as strings below
+            pass
+
+    result = (
+        values.astype(str)
+        .str.replace(' ', '', regex=False)
+        .str.replace('.0', '', regex=False)
+    )
+    is_zero_padded = result.str.fullmatch(r'0+[1-9][0-9]*')
+    result = result.where(~is_zero_padded, result.str.lstrip('0'))
+
+    return result.where(values.notna(), 'nan')
+
+
+def refine_data(csv_data: TextIO, subject_mapping: dict[str, SubjectItem]) -> pd.DataFrame:
     """
     This function loads a CSV file into pandas DataFrame and
     refines the data.
+
+    When csv_data is the result of refine_csv_column_names(), the name of
+    its layout and the known max possible score are kept in the `attrs`
+    of the result as 'csv_layout' and 'max_possible_score'.
+    """
+
+    _rewind(csv_data)
+    layout = getattr(csv_data, 'layout', None)
+    if layout:
+        data = read_refined_csv(csv_data, layout.column_names)
+    else:
+        data = pd.read_csv(csv_data)
+
+    return _refine_frame(data, subject_mapping, layout)
+
+
+def refine_data_chunks(csv_data: TextIO, subject_mapping: dict[str, SubjectItem], chunk_size: int) -> Iterator[pd.DataFrame]:
     """
+    Same as refine_data(), but the CSV is read and refined in chunks of
+    chunk_size rows. Only one chunk is kept in memory at a time, so the
+    memory usage does not depend on the size of the file.
 
-    csv_data.seek(0)
-    data = pd.read_csv(csv_data)
+    When the max possible score is not known from the CSV layout,
+    extract_scores_data() infers it per chunk, check _import_file_chunks()
+    in import_csv.py about how this is handled.
+    """
+
+    _rewind(csv_data)
+    layout = getattr(csv_data, 'layout', None)
+    dtype = csv_dtypes(layout.column_names) if layout else None
 
-    # convert school id column to str
-    data['school_admin_id'] = data['school_admin_id'].astype(str)
+    with pd.read_csv(csv_data, dtype=dtype, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield _refine_frame(chunk, subject_mapping, layout)
 
-    # In some CSV files the school ID contain spaces, in some it does not
-    # Here we remove all spaces from it.
-    data['school_admin_id'] = data['school_admin_id'].replace(' ', '', regex=True)
 
-    # For some CSV files the school ID loads as float and after conversion to
-    # string contains '.0' at the end, i.e. '1000002.0' should become '1000002'
-    data['school_admin_id'] = data['school_admin_id'].replace('\.0', '', regex=True)
+def _refine_frame(data: pd.DataFrame, subject_mapping: dict[str, SubjectItem], layout: Optional[CsvLayout]) -> pd.DataFrame:
+    """
+    Refines the data loaded by refine_data() or one chunk of it loaded by
+    refine_data_chunks(). All refinements are done row by row, so the
+    result does not depend on how the CSV is split into chunks.
+    """
+
+    data['school_admin_id'] = _refine_school_admin_id(data['school_admin_id'])
 
     # In some CSV files there are lines not for school, but for "Регионално
     # управление на образованието" or "РУО". Usually these lines are for small
@@ -462,7 +932,10 @@ def refine_data(csv_data: StringIO, subject_mapping: dict[str, SubjectItem]) ->
     # Some of these lines do not have city, municipality. In that cases
     # we use the value from the parent administrative unit.
     for nan_col, value_col in [ ('municipality', 'region'), ('place', 'municipality')]:
-        data.loc[data[nan_col].isna(), nan_col] = data[value_col].where(data[nan_col].isna())
+        missing = data[nan_col].isna()
+        if missing.any():
+            # object dtype, because the categorical columns do not accept new values
+            data[nan_col] = data[nan_col].astype(object).where(~missing, data[value_col].astype(object))
 
     # In the DZI CSV for 2017 There are results for two РУО without school_admin_id
     # Here we fill the school_admin_id, because we know it from other years.
@@ -470,46 +943,14 @@ def refine_data(csv_data: StringIO, subject_mapping: dict[str, SubjectItem]) ->
     data.loc[(data['school_admin_id'] == 'nan') & (data['place'] == 'Пазарджик'), 'school_admin_id'] = '1300'
 
     # unify all variations of Чужбина regions/municipalities
-    def _unify_foreign_country(v):
-        if 'чужбина' in v.lower():
-            return 'Чужбина'
-        else:
-            return v
-
-    data['region'] = data['region'].apply(_unify_foreign_country)
-    data['region'] = data['region'].str.title()
-
-    data['municipality'] = data['municipality'].apply(_unify_foreign_country)
-    data['municipality'] = data['municipality'].str.title()
-
-
-    def _get_pretty_place(value: str) -> str:
-        """
-        Formats cities and villages in standard way.
-        TODO: Some places do not contain `гр.` and `с.` prefixes, as result
-        in the database we have `гр. София` and `София` records.
-        """
-        if not value:
-            return value
+    # The place names repeat thousands of times in each file, so the
+    # formatting functions are applied once per distinct value.
+    data['region'] = _map_unique(data['region'], _pretty_region_or_municipality)
+    data['municipality'] = _map_unique(data['municipality'], _pretty_region_or_municipality)
+    data['place'] = _map_unique(data['place'], _get_pretty_place)
 
-        def _upper_first(s: str) -> str:
-            if not s:
-                return s
-
-            s = s.strip()
-            return s[0].upper() + s[1:].lower()
-
-        try:
-            if '.' in value:
-                prefix, name = value.split('.')
-                return f'{prefix.strip().lower()}. {_upper_first(name)}'
-            else:
-                return _upper_first(value.strip())
-        except:
-            logger.error('Failed to make pretty place from value %s', value)
-            raise
-
-    data['place'] = data['place'].apply(_get_pretty_place)
+    for c in PLACE_COLUMNS:
+        data[c] = data[c].astype('category')
 
     # Convert people columns to int
     people_cols = [c for c in data.columns if is_people_column(c)]
@@ -522,7 +963,10 @@ def refine_data(csv_data: StringIO, subject_mapping: dict[str, SubjectItem]) ->
     score_cols = [c for c in data.columns if is_score_column(c)]
     for c in score_cols:
         logger.verbose_info('converting to float score column %s', c)
-        fixed = data[c].replace(',', '.', regex=True)
+        fixed = data[c]
+        if pd.api.types.is_object_dtype(fixed):
+            # some of the files use decimal comma
+            fixed = fixed.str.replace(',', '.', regex=False)
         # dzi-2022 contains one cell with value '('
         fixed = fixed.replace('(',None)
         fixed = fixed.astype(float)
@@ -576,6 +1020,11 @@ def refine_data(csv_data: StringIO, subject_mapping: dict[str, SubjectItem]) ->
     data = data.rename(columns=renamings_map)
     logger.verbose_info('Columns after  subject remapping: %s', data.columns)
 
+    if layout:
+        data.attrs['csv_layout'] = layout.name
+        if layout.max_possible_score is not None:
+            data.attrs['max_possible_score'] = layout.max_possible_score
+
     return data
 
 
@@ -594,6 +1043,10 @@ def extract_scores_data(data: pd.DataFrame) -> pd.DataFrame:
 
     This means tha for every pair (people, score) it generates a line for
     the corresponding school.
+
+    The frame is reshaped from wide to long form at once - the subject
+    columns are stacked subject by subject, so the rows are in the same
+    order as if the per-subject frames were concatenated.
     """
     subject_cols = [c for c in data.columns if is_subject_column(c)]
     subject_cols_count = len(subject_cols)
@@ -601,54 +1054,51 @@ def extract_scores_data(data: pd.DataFrame) -> pd.DataFrame:
     assert subject_cols_count % 2 == 0, \
         f'Subject column count should be an even number, but it is {subject_cols_count}. Columns are: {subject_cols}'
 
-    cols_to_extract = ['school_admin_id', *subject_cols]
-
-    # This DataFrame contains only school_admin_id and subject columns
-    scores : pd.DataFrame = data.loc[:, cols_to_extract]
-
     subject_count = subject_cols_count // 2
 
     logger.verbose_info('subject_cols_count -> %d, subject_count -> %d', subject_cols_count, subject_count)
 
-    # The for loop below will generate a DataFrame for each subject.
-    # The data frame will be added in this list.
-    # At the end this list will be concatenated.
-    subject_df = []
+    # The subject columns are paired by subject, check refine_data().
+    subject_names = []
+    people_cols = []
+    score_cols = []
     for i in range(subject_count):
-        # +1 is added because the scores DataFrame contains school_admin_id
-        subject_cols = scores.columns[i*2+1 : i*2+1+2]
-        logger.verbose_info('subject_cols -> %s', subject_cols )
-
-        subject_name = subject_cols[0].split(' ')[SBJ_IDX]
-        logger.verbose_info('extracted subject_name -> %s', subject_name)
-        assert subject_name in subject_cols[1], \
-            f'The two columns do not contain the same subject name {subject_cols}'
-
-        subject_name = subject_name.upper()
-        logger.verbose_info('subject_name -> %s', subject_name)
-
-        df = scores.loc[:, ['school_admin_id', *subject_cols]]
-
-        # rename the columns to be just 'people' and 'score', in other words
-        # we remove the subject name from the column names
-        renaming_cols = { c: c.split(' ')[ATTR_IDX] for c in subject_cols }
-        df = df.rename(columns=renaming_cols)
-
-        # insert the subject in the dataframe
-        df.insert(1, 'subject', subject_name)
-
-        # infer and insert the max possible score
-        max_possible_score = infer_max_possible_nvo_score(df)
-        df.insert(1, 'max_possible_score', max_possible_score)
-
-        # we are ready
-        subject_df.append(df)
+        pair = subject_cols[i*2 : i*2+2]
+
+        subject_name = pair[0].split(' ')[SBJ_IDX]
+        assert subject_name in pair[1], \
+            f'The two columns do not contain the same subject name {pair}'
+
+        subject_names.append(subject_name.upper())
+        people_cols.append(next(c for c in pair if is_people_column(c)))
+        score_cols.append(next(c for c in pair if is_score_column(c)))
+
+    logger.verbose_info('subject_names -> %s', subject_names)
+
+    rows_count = len(data)
+    scores = data[score_cols].to_numpy(dtype=float)
+
+    # the max possible score per subject, it is inferred from the data if
+    # the CSV layout does not define it
+    max_possible_score = data.attrs.get('max_possible_score')
+    if max_possible_score is None:
+        max_scores = data[score_cols].max().to_numpy(dtype=float)
+        max_possible_scores = _max_possible_nvo_scores(max_scores)
+    else:
+        max_possible_scores = np.full(subject_count, max_possible_score, dtype=float)
+
+    # Fortran order stacks the columns one after another
+    result = pd.DataFrame({
+        'school_admin_id': np.tile(data['school_admin_id'].to_numpy(), subject_count),
+        'max_possible_score': np.repeat(max_possible_scores, rows_count),
+        'subject': np.repeat(np.array(subject_names, dtype=object), rows_count),
+        'people': data[people_cols].to_numpy().ravel(order='F'),
+        'score': scores.ravel(order='F'),
+    })
 
-    # concat all subject data frames in one, sort by school_admin_id
-    result = pd.concat(subject_df, ignore_index=True)
     result = result[result['score'] > 0]
     result = result.sort_values('school_admin_id')
-    result = result.reset_index()
+    result = result.reset_index(drop=True)
 
     return result
 
@@ -659,12 +1109,12 @@ def main():
     """
 
     csv_file = sys.argv[1]
-    raw_data = load_csv(csv_file)
-    raw_data = refine_csv_column_names(raw_data)
-    raw_data.seek(0)
 
     subject_mapping = load_subject_abbr_map()
-    refined_data = refine_data(raw_data, subject_mapping)
+    with open_csv(csv_file) as raw_data:
+        raw_data = refine_csv_column_names(raw_data)
+        logger.info('CSV layout: %s', raw_data.layout)
+        refined_data = refine_data(raw_data, subject_mapping)
     print(refined_data.loc[:3])
 
     schools_data = extract_school_data(refined_data)
@@ -3,18 +3,28 @@ In this file is kept the runtime state for the current execution of the
 CLI application or given DAG. This includes:
 * is the execution a dry run
 * is verbose logging enabled
+* is profiling enabled, check profiled() below
 
 Here is also implemented custom VerboseLogger logging sub-class which
 is used by the CLI app and the DAGs.
 It respects the current state of is_verbose().
 """
 
+import cProfile
+import io
 import logging
+import pstats
 import sys
 import os
+import threading
+import time
+import tracemalloc
 
+from collections import Counter
+from contextlib import contextmanager
 from functools import cache
 from datetime import datetime
+from typing import Optional
 from zoneinfo import ZoneInfo
 
 
@@ -22,6 +32,7 @@ from zoneinfo import ZoneInfo
 # application or DAG.
 _verbose = False
 _dry_run = False
+_profiling = False
 
 _now = datetime.now(ZoneInfo('UTC')).strftime('%Y-%m-%dT%H-%M-%S')
 
@@ -44,6 +55,15 @@ def is_dry_run() -> bool:
     return _dry_run
 
 
+def enable_profiling():
+    global _profiling
+    _profiling = True
+
+
+def is_profiling() -> bool:
+    return _profiling
+
+
 @cache
 def edit_stamp() -> str:
     user = os.environ.get('USER', 'unknown')
@@ -83,3 +103,136 @@ def getLogger(name: str) -> VerboseLogger:
         )
 
     return l
+
+
+PROFILE_SAMPLING_INTERVAL = 0.005
+
+PROFILE_TOP_SIZE = 30
+
+
+def _log_dir() -> Optional[str]:
+    """
+    Returns the directory of the log files - the one of the log file of the
+    root logger or of the Airflow logs when running in Airflow task.
+    """
+    for handler in logging.getLogger().handlers:
+        filename = getattr(handler, 'baseFilename', None)
+        if filename:
+            return os.path.dirname(filename)
+
+    log_dir = os.environ.get('AIRFLOW__LOGGING__BASE_LOG_FOLDER')
+    if log_dir:
+        return log_dir
+
+    airflow_home = os.environ.get('AIRFLOW_HOME')
+    if not airflow_home and os.environ.get('AIRFLOW_CTX_DAG_RUN_ID'):
+        # the default AIRFLOW_HOME
+        airflow_home = os.path.join(os.path.expanduser('~'), 'airflow')
+
+    return os.path.join(airflow_home, 'logs') if airflow_home else None
+
+
+def get_profile_dir() -> str:
+    """
+    Returns PROFILE_DIR or the directory `profiles` next to the log files.
+    Raises RuntimeError when neither is known, e.g. when the logs are
+    written only to the console.
+    """
+    profile_dir = os.environ.get('PROFILE_DIR')
+    if profile_dir:
+        return profile_dir
+
+    log_dir = _log_dir()
+    if log_dir:
+        return os.path.join(log_dir, 'profiles')
+
+    raise RuntimeError('Cannot find the directory of the log files, set PROFILE_DIR to the directory for the profiles.')
+
+
+class _StackSampler(threading.Thread):
+    """
+    Samples the stack of the thread with thread_id every interval seconds
+    and counts the samples per stack, in the collapsed stack format used by
+    flamegraph.pl and speedscope.
+    """
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name='profile-stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+@contextmanager
+def profiled(name: str):
+    """
+    When profiling is enabled, profiles the code in the with block and
+    writes in get_profile_dir() three files:
+    * <name>-<timestamp>.pstats - cProfile stats, e.g. for snakeviz
+    * <name>-<timestamp>.collapsed - sampled stacks for flamegraph
+    * <name>-<timestamp>.allocations.txt - the top memory allocations
+      according to tracemalloc
+
+    The top functions by cumulative time are also logged.
+    Note that the profilers slow down the execution.
+
+    If tracemalloc is already tracing, e.g. because of METRICS_TRACEMALLOC
+    in metrics.py, it is left running.
+    """
+    if not is_profiling():
+        yield
+        return
+
+    profile_dir = get_profile_dir()
+    os.makedirs(profile_dir, exist_ok=True)
+    base_path = os.path.join(profile_dir, f'{name}-{_now}')
+
+    logger = getLogger(__name__)
+    logger.info('Profiling %s, the results will be written in %s.*', name, base_path)
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLING_INTERVAL)
+    profile = cProfile.Profile()
+
+    started = time.perf_counter()
+    sampler.start()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        if not was_tracing:
+            tracemalloc.stop()
+
+        profile.dump_stats(f'{base_path}.pstats')
+
+        with open(f'{base_path}.collapsed', 'wt') as f:
+            for stack, count in sampler.stacks.items():
+                f.write(f'{stack} {count}\n')
+
+        with open(f'{base_path}.allocations.txt', 'wt') as f:
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP_SIZE]:
+                f.write(f'{stat}\n')
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_SIZE)
+        logger.info('Profile of %s (%.3fs):\n%s', name, time.perf_counter() - started, summary.getvalue())
@@ -1,16 +1,29 @@
+import codecs
+import csv
+import json
 import os
 import re
-from SPARQLWrapper import SPARQLWrapper, JSON
+import tempfile
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import Table
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 from collections import OrderedDict, defaultdict
-from cache_decorator import Cache
 
 from .runtime import getLogger
-from .db_actions import insert_or_update_object, ImportAction
+from .db_actions import (
+    insert_or_update_object, bulk_upsert_objects, commit_batches, ImportAction,
+    get_wikidata_watermarks, set_wikidata_watermark
+)
 from .db import get_db_engine
 from .db_models import Region, Municipality, Place, School, EDIT_STAMP
+from .wikidata_cache import get_wikidata_cache
 
 
 logger = getLogger(__name__)
@@ -19,33 +32,45 @@ logger = getLogger(__name__)
 SUPPORTED_IMPORT_WIKIDATA_TYPES = ('regions', 'muns', 'places', 'schools')
 
 
-def _ensure_cache_dir():
-    value = None
-    for name in ['HOME', 'TMP', 'TMPDIR']:
-        value = os.environ.get(name)
-        if value:
-            break
-    else:
-        value = '/tmp'
-
-    cache_dir = os.path.join(value, '.cache', 'data-for-good', 'semantic_schools', 'wikidata')
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir, exist_ok=True)
-
-    return cache_dir
-
-
-_CACHE_DIR = _ensure_cache_dir()
-
-
 # To use wikidata query endpoint we need to provide user-agent as it is
 # documented here: https://foundation.wikimedia.org/wiki/Policy:User-Agent_policy
 #
 # Additionally the results from queries made against wikidata are cached on
-# the file system for a day.
+# the file system, check wikidata_cache.py.
 CONTACT_EMAIL = 'info+semantic-schools@data-for-good.bg'
 USER_AGENT = f'User-Agent: semantic-schools/0.1 (https://data-for-good.bg/; {CONTACT_EMAIL}) semantic-schools/0.1'
 
+# The endpoint could be changed to a local SPARQL service, e.g. for testing.
+SPARQL_ENDPOINT = os.environ.get('WIKIDATA_SPARQL_ENDPOINT', 'https://query.wikidata.org/sparql')
+
+# The queries are sent in parallel, but politely - the query service allows
+# up to 5 parallel queries per client, check
+# https://www.mediawiki.org/wiki/Wikidata_Query_Service/User_Manual#Query_limits
+# so at most SPARQL_MAX_WORKERS queries are sent at the same time and
+# at least SPARQL_MIN_INTERVAL seconds pass between the starts of two queries.
+SPARQL_MAX_WORKERS = int(os.environ.get('WIKIDATA_SPARQL_WORKERS', '3'))
+SPARQL_MIN_INTERVAL = float(os.environ.get('WIKIDATA_SPARQL_MIN_INTERVAL', '1'))
+
+# The results of the queries are fetched in pages of SPARQL_PAGE_SIZE rows
+# with LIMIT/OFFSET. The fetching does not wait for the writing into the DB,
+# the pages which wait to be written are kept in a temporary file, in memory
+# up to SPARQL_SPOOL_MEMORY bytes per query, check _PageSpool.
+# A page which fails because of timeout or overloaded service is retried
+# up to SPARQL_RETRIES times, the other pages are not fetched again.
+SPARQL_PAGE_SIZE = int(os.environ.get('WIKIDATA_SPARQL_PAGE_SIZE', '2000'))
+SPARQL_SPOOL_MEMORY = 4 * 1024 * 1024
+SPARQL_RETRIES = int(os.environ.get('WIKIDATA_SPARQL_RETRIES', '3'))
+SPARQL_RETRY_DELAY = 5
+SPARQL_TIMEOUT = (10, 120)
+
+_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# The incremental imports ask only for the entities modified after the
+# previous import, check import_from_wikidata(). The query service lags
+# behind wikidata, so the entities modified up to SYNC_OVERLAP before the
+# previous import are asked again.
+SYNC_OVERLAP = timedelta(hours=int(os.environ.get('WIKIDATA_SYNC_OVERLAP_HOURS', '24')))
+
 
 # NB: Look here for details around wikidata entries for Bulgaria
 # https://www.wikidata.org/wiki/Wikidata:WikiProject_Bulgaria/Administrative_Entities
@@ -65,6 +90,10 @@ USER_AGENT = f'User-Agent: semantic-schools/0.1 (https://data-for-good.bg/; {CON
 # The SPARQL queries below are processed by the function _import_sparql_result.
 # Its documentation explains the convention about the naming of the columns
 # in the SPARQL queries.
+#
+# The results are paginated with LIMIT/OFFSET, so `order by` of each query
+# should list all selected columns, otherwise some rows might be repeated or
+# missed between the pages.
 
 REGION_SPARQL = '''
 SELECT distinct ?id ?name ?coordinates ?area_id WHERE {
@@ -80,7 +109,7 @@ SELECT distinct ?id ?name ?coordinates ?area_id WHERE {
     ?region rdfs:label ?name.
   }
 }
-order by ?name
+order by ?name ?id ?coordinates ?area_id
 '''
 
 MUN_SPARQL = '''
@@ -103,7 +132,7 @@ SELECT distinct ?region_id ?id ?name ?coordinates ?area_id  WHERE {
     ?region rdfs:label ?regionLabel.
   }
 }
-order by ?regionLabel ?munLabel
+order by ?regionLabel ?munLabel ?region_id ?id ?name ?coordinates ?area_id
 '''
 
 
@@ -141,7 +170,7 @@ SELECT distinct ?municipality_id ?id ?name ?coordinates ?area_id WHERE {{
 
   }}
 }}
-order by ?munLabel ?name
+order by ?munLabel ?name ?municipality_id ?id ?coordinates ?area_id
 '''
 
 # NB: This query is similar to the above one, but extracts cities or villages
@@ -202,37 +231,135 @@ SELECT distinct ?place_id ?id ?name ?wikidata_id ?coordinates WHERE {
     ?bgSchoolId rdfs:label ?id.
   }
 }
-order by ?placeLabel ?id ?name
+order by ?placeLabel ?id ?name ?place_id ?wikidata_id ?coordinates
 '''
 
 
-def _flatten_sparql_json_result(sparql_json_result: dict) -> list[dict]:
-    result = []
-    for item in sparql_json_result['results']['bindings']:
-        flatten_item = {
-            binding : binding_value['value']
-            for binding, binding_value in item.items()
-        }
-        result.append(flatten_item)
+class _PolitenessLimiter:
+    """
+    Limits the number of the concurrent queries and the rate at which
+    they are started.
+    """
 
-    return result
+    def __init__(self, max_concurrent: int, min_interval: float):
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._min_interval = min_interval
+        self._last_started = None
 
+    @contextmanager
+    def acquire(self):
+        with self._semaphore:
+            with self._lock:
+                if self._last_started is not None:
+                    wait = self._last_started + self._min_interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                self._last_started = time.monotonic()
 
-@Cache(
-    cache_path='/'.join(['{cache_dir}','{function_name}-{_hash}.json']),
-    validity_duration='1d',
-    cache_dir=_CACHE_DIR
-)
-def _extract_wikidata_via_sparql(query: str):
-    logger.info(query)
+            yield
 
-    sparql = SPARQLWrapper('https://query.wikidata.org/sparql', USER_AGENT)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    data = sparql.query().convert()
-    flatten = _flatten_sparql_json_result(data)
 
-    return flatten
+_limiter = _PolitenessLimiter(SPARQL_MAX_WORKERS, SPARQL_MIN_INTERVAL)
+
+
+def _modified_since(query: str, entity: str, since: datetime) -> str:
+    """
+    Adds filter to the query, so it returns only the rows where the entity
+    in the variable `entity` is modified after `since`.
+    """
+    label_service = '  SERVICE wikibase:label'
+    if label_service not in query:
+        raise ValueError(f'Cannot add filter by modification date to the query:\n{query}')
+
+    since_str = since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    condition = (
+        f'  ?{entity} schema:dateModified ?modified.\n'
+        f'  FILTER(?modified > "{since_str}"^^xsd:dateTime).\n\n'
+    )
+
+    return query.replace(label_service, condition + label_service, 1)
+
+
+def _paginate(query: str, limit: int, offset: int) -> str:
+    return f'{query.rstrip()}\nLIMIT {limit} OFFSET {offset}\n'
+
+
+_LINE_END_RE = re.compile(r'(?<=\n)|(?<=\r)(?!\n)')
+
+
+def _iter_text_lines(response: requests.Response) -> Iterator[str]:
+    """
+    Yields the lines of the body with their line endings, so the quoted
+    values spanning lines are parsed by csv as with newline=''.
+    The body is read with iter_content(), which raises requests exceptions.
+    """
+    rest = ''
+    for text in codecs.iterdecode(response.iter_content(chunk_size=64 * 1024), 'utf-8'):
+        lines = _LINE_END_RE.split(rest + text)
+        rest = lines.pop()
+        # a \r at the end of the chunk may be followed by \n in the next one
+        if lines and lines[-1].endswith('\r'):
+            rest = lines.pop() + rest
+        yield from lines
+    if rest:
+        yield rest
+
+
+def _stream_sparql_csv(query: str) -> Iterator[dict]:
+    """
+    Runs the query and parses the CSV result row by row while it is being
+    downloaded. The unbound values are omitted, as in the JSON results.
+    """
+    with requests.post(
+        SPARQL_ENDPOINT,
+        data={'query': query},
+        headers={'Accept': 'text/csv', 'User-Agent': USER_AGENT},
+        stream=True,
+        timeout=SPARQL_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        reader = csv.DictReader(_iter_text_lines(response))
+        for row in reader:
+            yield {name: value for name, value in row.items() if value}
+
+
+def _is_retryable(error: requests.RequestException) -> bool:
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in _RETRY_STATUS_CODES
+
+    return isinstance(error, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError))
+
+
+def _retry_delay(error: requests.RequestException, attempt: int) -> float:
+    retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+
+    return SPARQL_RETRY_DELAY * 2 ** (attempt - 1)
+
+
+def _extract_wikidata_via_sparql(query: str) -> list[dict]:
+    """
+    Returns the result of the query, one page of it in fact, check _extract_pages_via_sparql().
+    The results are cached by _fetch_pages().
+    """
+    for attempt in range(1, SPARQL_RETRIES + 1):
+        try:
+            with _limiter.acquire():
+                logger.info(query)
+                started = time.monotonic()
+                result = list(_stream_sparql_csv(query))
+                logger.info('SPARQL query returned %d rows in %.1fs', len(result), time.monotonic() - started)
+
+            return result
+        except requests.RequestException as e:
+            if attempt == SPARQL_RETRIES or not _is_retryable(e):
+                raise
+
+            delay = _retry_delay(e, attempt)
+            logger.warning('SPARQL query failed (attempt %d of %d), will retry in %ds: %s', attempt, SPARQL_RETRIES, delay, e)
+            time.sleep(delay)
 
 
 def _extract_coordinates(point: str) -> tuple[Optional[str], Optional[str]]:
@@ -275,10 +402,52 @@ def _update_area_id(wikidata_item: dict):
             wikidata_item['area_id'] = full_area_id
 
 
-def _import_sparql_result(session: Session, sparql: str, model: Table, constant_values: Optional[dict] = None) -> dict[ImportAction, int]:
+def _sparql_rows(sparql_result: list[dict], model: Table, constant_values: dict, known: set, counts: dict[ImportAction, int]) -> list[dict]:
+    """
+    Converts the SPARQL result items to rows with the same columns as the
+    model - the missing values are taken from constant_values or are None.
+    The items with ids in `known` are counted as ImportAction.Skipped,
+    the ids of the other items are added to it.
     """
-    This function runs a SPARQL query and for each result item it will
-    insert or update record in the table specified via the model param.
+    columns = [col.name for col in model.columns if col.name != EDIT_STAMP]
+
+    rows = []
+    for result_item in sparql_result:
+        if result_item['id'] in known:
+            # All wikidata queries may return multiple records with the same ID
+            # This might be caused by different reasons. In some cases
+            # a region/place/municipality has multiple instances of Coordinates
+            # property. In other cases multiple schools with the same bg_school_id.
+            #
+            # In all these cases what we do is to use the first record from
+            # the query result and skip the other.
+            logger.warning('Skipping %s %s', model.name, result_item)
+            counts[ImportAction.Skipped] += 1
+            continue
+
+        known.add(result_item['id'])
+
+        _update_area_id(result_item)
+        _update_coordinates(result_item)
+
+        row = {}
+        for name in columns:
+            value = result_item.get(name)
+            if value is None:
+                value = constant_values.get(name)
+            row[name] = value
+
+        rows.append(row)
+
+    return rows
+
+
+def _import_sparql_result(session: Session, pages: Iterable[list[dict]], model: Table, constant_values: Optional[dict] = None) -> dict[ImportAction, int]:
+    """
+    This function takes the result of a SPARQL query and for each result item
+    it will insert or update record in the table specified via the model param.
+    The records of each page are written with bulk_upsert_objects, only the
+    changed records are updated.
 
     The following conventions are implemented here:
     * The target table should have column named `id`
@@ -298,7 +467,7 @@ def _import_sparql_result(session: Session, sparql: str, model: Table, constant_
 
     Parameters:
       session: SQLAlchemy session which will execute the DB operations
-      sparql: The SPARQL query
+      pages: The pages of the result of the SPARQL query, check _fetch_pages
       mode: The SQLAlchemy Table object representing the target table
       constant_values: An optional dictionary with values that should be
       added to all records.
@@ -311,86 +480,233 @@ def _import_sparql_result(session: Session, sparql: str, model: Table, constant_
     if constant_values is None:
         constant_values = {}
 
-    sparql_result = _extract_wikidata_via_sparql(sparql)
     known = set()
-    for result_item in sparql_result:
-        if result_item['id'] in known:
-            # All wikidata queries may return multiple records with the same ID
-            # This might be caused by different reasons. In some cases
-            # a region/place/municipality has multiple instances of Coordinates
-            # property. In other cases multiple schools with the same bg_school_id.
-            #
-            # In all these cases what we do is to use the first record from
-            # the query result and skip the other.
-            logger.warning('Skipping %s %s', model.name, result_item)
-            counts[ImportAction.Skipped] += 1
+    for page in pages:
+        rows = _sparql_rows(page, model, constant_values, known, counts)
+        for action, count in bulk_upsert_objects(session, model, [model.c.id], rows).items():
+            counts[action] += count
+
+    return counts
+
+
+def _import_bankya(session: Session):
+    # Bankya is handled specially, because it is the only city in Bulgaria
+    # which does not belong (P:131) to a municipality of Bulgaria. So
+    # because of this it is not imported as all other cities and villages
+    insert_or_update_object(session, Place, Place.c.id, OrderedDict([
+        (Place.c.id, 'http://www.wikidata.org/entity/Q806817'),
+        (Place.c.name, 'Банкя'),
+        (Place.c.municipality_id, 'http://www.wikidata.org/entity/Q4442915'),
+        (Place.c.type, 'град'),
+        (Place.c.area_id, None),
+        (Place.c.longitude, '23.147239'),
+        (Place.c.latitude, '42.706945')
+    ]))
+
+
+@dataclass
+class WikidataQuery:
+    name: str
+    sparql: str
+    model: Table
+    # the variable of the imported entity in the query
+    entity: str
+    constant_values: Optional[dict] = None
+    incremental: bool = False
+    # called with the session after the result of the query is written
+    after_import: Optional[Callable[[Session], None]] = None
+
+
+def _get_queries(to_import) -> list[WikidataQuery]:
+    """
+    Returns the queries for the data to import, in the order in which their
+    results should be written - regions, municipalities, places and schools,
+    because of the foreign keys.
+    """
+    queries = []
+
+    if 'regions' in to_import:
+        queries.append(WikidataQuery(Region.name, REGION_SPARQL, Region, 'region'))
+
+    if 'muns' in to_import:
+        queries.append(WikidataQuery(Municipality.name, MUN_SPARQL, Municipality, 'mun'))
+
+    if 'places' in to_import:
+        for place_type in [CITY_IN_BULGARIA, VILLAGE_IN_BULGARIA]:
+            display_type = DISPLAY_PLACE_TYPE[place_type]
+            queries.append(WikidataQuery(Place.name + '-' + display_type, PLACE_SPARQL.format(place_type), Place, 'place', {'type': display_type}))
+        queries[-1].after_import = _import_bankya
+
+    if 'schools' in to_import:
+        queries.append(WikidataQuery(School.name, SCHOOL_QUERY, School, 'school'))
+
+    return queries
+
+
+def _make_incremental(queries: list[WikidataQuery], watermarks: dict[str, datetime]):
+    """
+    Changes the queries to return only the entities modified after their
+    watermarks. The queries without watermark are left as they are.
+    """
+    for query in queries:
+        watermark = watermarks.get(query.name)
+        if watermark is None:
+            logger.info('There is no previous import of %s, all of it will be imported', query.name)
             continue
 
-        known.add(result_item['id'])
+        since = watermark - SYNC_OVERLAP
+        logger.info('Importing %s modified after %s', query.name, since.isoformat())
+        query.sparql = _modified_since(query.sparql, query.entity, since)
+        query.incremental = True
 
-        _update_area_id(result_item)
-        _update_coordinates(result_item)
 
-        key_values = []
-        for col in model.columns:
-            if col.name == EDIT_STAMP:
-                continue
+class _PageSpool:
+    """
+    Passes the pages of one query result from the thread which fetches them
+    to the one which writes them into the DB. The fetching never waits for
+    the writing, the pages are kept in a temporary file until they are
+    read, so the memory does not depend on the size of the result.
+    """
 
-            value = result_item[col.name] \
-                if col.name in result_item \
-                else None
-            if value is None:
-                value = constant_values[col.name] \
-                    if col.name in constant_values \
-                    else None
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPARQL_SPOOL_MEMORY)
+        self._condition = threading.Condition()
+        self._read_offset = 0
+        self._pending = 0
+        self._done = False
+        self._error = None
+
+    def put(self, page: list[dict]):
+        data = (json.dumps(page, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._condition:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._pending += 1
+            self._condition.notify()
+
+    def finish(self, error: Exception = None):
+        """
+        Called after the last page, with the error when the fetching failed.
+        """
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify()
+
+    def __iter__(self) -> Iterator[list[dict]]:
+        """
+        Yields the pages as they are put and then raises the error of the
+        fetching if any.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._done)
+                if not self._pending:
+                    self._file.close()
+                    if self._error is not None:
+                        raise self._error
+                    return
+
+                self._file.seek(self._read_offset)
+                line = self._file.readline()
+                self._read_offset = self._file.tell()
+                self._pending -= 1
+
+            yield json.loads(line)
+
+
+def _extract_pages_via_sparql(sparql: str) -> Iterator[list[dict]]:
+    """
+    Yields the result of the query page by page, the last page is shorter
+    than SPARQL_PAGE_SIZE, possibly empty.
+    """
+    offset = 0
+    while True:
+        page = _extract_wikidata_via_sparql(_paginate(sparql, SPARQL_PAGE_SIZE, offset))
+        yield page
+        if len(page) < SPARQL_PAGE_SIZE:
+            return
+        offset += SPARQL_PAGE_SIZE
 
-            key_values.append( (col, value) )
 
-        od = OrderedDict(key_values)
+def _fetch_pages(query: WikidataQuery, pages: _PageSpool, stop: threading.Event, offline: bool, fetched_at: dict[str, datetime]):
+    """
+    Fetches the result of the query page by page and puts the pages in the
+    spool, then finishes it, with the exception when the fetching fails.
+    Stops when the `stop` event is set.
 
-        action = insert_or_update_object(session, model, model.columns['id'], od)
-        counts[action] += 1
+    All pages are taken from the wikidata cache when possible, in offline
+    mode only from the cache. The time when the result was fetched from
+    wikidata is set in fetched_at[query.name] before the first page.
+    """
+    try:
+        result = get_wikidata_cache().get(query.sparql, _extract_pages_via_sparql, offline)
+        fetched_at[query.name] = datetime.fromtimestamp(result.created, timezone.utc)
+        for page in result.pages:
+            if stop.is_set():
+                return
+            pages.put(page)
 
-    return counts
+        pages.finish()
+    except Exception as e:
+        pages.finish(e)
 
 
-def import_from_wikidata(to_import = SUPPORTED_IMPORT_WIKIDATA_TYPES):
+def import_from_wikidata(to_import = SUPPORTED_IMPORT_WIKIDATA_TYPES, offline: bool = False, incremental: bool = False):
     """
     Imports information for regions, municipalities, places (cities and villages)
     and schools from wikidata into the relational DB.
+
+    All SPARQL queries are fetched in parallel, each by its own thread, but
+    at most SPARQL_MAX_WORKERS pages are requested at the same time. Their
+    results are fetched page by page and written into the DB one by one in
+    the order of the foreign keys, while the rest of the queries are still
+    running - a query never waits for the writing of the previous ones,
+    check _PageSpool.
+
+    The results are cached, check wikidata_cache.py. In offline mode only
+    the cached results are used and the import fails if any is missing.
+
+    For each successful import the time when its result was fetched from
+    wikidata is recorded in the wikidata_sync table - for a cached result
+    that is when it was cached, not the time of the import. In incremental
+    mode only the entities modified after the previous import (minus
+    SYNC_OVERLAP) are imported, check _make_incremental().
     """
 
     counters = dict()
+    fetched_at = dict()
+    queries = _get_queries(to_import)
+    spools = [_PageSpool() for _ in queries]
+    stop = threading.Event()
 
     db = get_db_engine()
-    with Session(db) as session:
-        if 'regions' in to_import:
-            counters[Region.name] = _import_sparql_result(session, REGION_SPARQL, Region)
-
-        if 'muns' in to_import:
-            counters[Municipality.name] = _import_sparql_result(session, MUN_SPARQL, Municipality)
-
-        if 'places' in to_import:
-            for place_type in [CITY_IN_BULGARIA, VILLAGE_IN_BULGARIA]:
-                counters[Place.name+'-' + DISPLAY_PLACE_TYPE[place_type]] = _import_sparql_result(session, PLACE_SPARQL.format(place_type), Place, {'type': DISPLAY_PLACE_TYPE[place_type]})
-
-            # # Bankya is handled specially, because it is the only city in Bulgaria
-            # # which does not belong (P:131) to a municipality of Bulgaria. So
-            # # because of this it is not imported as all other cities and villages
-            insert_or_update_object(session, Place, Place.c.id, OrderedDict([
-                (Place.c.id, 'http://www.wikidata.org/entity/Q806817'),
-                (Place.c.name, 'Банкя'),
-                (Place.c.municipality_id, 'http://www.wikidata.org/entity/Q4442915'),
-                (Place.c.type, 'град'),
-                (Place.c.area_id, None),
-                (Place.c.longitude, '23.147239'),
-                (Place.c.latitude, '42.706945')
-            ]))
-
-        if 'schools' in to_import:
-            counters[School.name] = _import_sparql_result(session, SCHOOL_QUERY, School)
-
-        session.commit()
+    if incremental:
+        with Session(db) as session:
+            _make_incremental(queries, get_wikidata_watermarks(session))
+    # the concurrent requests are limited by _limiter, not by the threads
+    with ThreadPoolExecutor(max_workers=max(len(queries), 1), thread_name_prefix='sparql') as executor:
+        for query, pages in zip(queries, spools):
+            executor.submit(_fetch_pages, query, pages, stop, offline, fetched_at)
+        try:
+            with Session(db) as session, commit_batches(session):
+                for query, pages in zip(queries, spools):
+                    counters[query.name] = _import_sparql_result(session, pages, query.model, query.constant_values)
+                    if query.after_import:
+                        query.after_import(session)
+
+                for query in queries:
+                    set_wikidata_watermark(session, query.name, fetched_at[query.name], query.incremental, sum(counters[query.name].values()))
+
+                session.commit()
+        except BaseException:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    cache = get_wikidata_cache()
+    cache.wait()
+    cache.log_stats()
 
     logger.info('Summary of operations per model')
 
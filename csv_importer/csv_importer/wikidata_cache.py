@@ -0,0 +1,311 @@
+"""
+File system cache of the results of the wikidata SPARQL queries, check
+wikidata.py.
+
+Each result is stored as gzip compressed JSON lines file named by the
+SHA-256 hash of the normalized query text - the query with collapsed white
+space, so the formatting of the queries does not matter. The first line
+holds the query and the time of the result, each next line one page of
+the result. The pages of a query are fetched, cached and refreshed
+together, so the pages of one result are never from different times.
+They are written and read one by one, so a result is never held in memory
+as a whole.
+
+The cached results are used as follows:
+* younger than max_age - the result is returned
+* younger than max_stale_age - the result is returned and it is refreshed
+  in background, stale-while-revalidate
+* older or missing - the query is run, but if it fails and there is an old
+  result, the old result is returned
+
+In offline mode the network is never used, any cached result is returned
+and a missing one raises WikidataCacheMiss.
+
+The whole cache could be exported to one bundle file and imported on
+another machine, e.g. DAG worker or CI, which could then run the import
+in offline mode.
+
+The directory is WIKIDATA_CACHE_DIR, by default
+$HOME/.cache/data-for-good/semantic_schools/wikidata, and it is created
+when the first result is written.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+
+from dataclasses import dataclass, asdict
+from typing import Callable, Iterable, Iterator, Optional, TextIO
+
+from .runtime import getLogger, is_dry_run
+
+
+logger = getLogger(__name__)
+
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+DEFAULT_MAX_STALE_AGE = 30 * 24 * 60 * 60
+
+_ENTRY_SUFFIX = '.jsonl.gz'
+_ENTRY_NAME_RE = re.compile(r'^[0-9a-f]{64}\.jsonl\.gz$')
+
+
+class WikidataCacheMiss(Exception):
+    pass
+
+
+def _default_cache_dir() -> str:
+    value = None
+    for name in ['HOME', 'TMP', 'TMPDIR']:
+        value = os.environ.get(name)
+        if value:
+            break
+    else:
+        value = '/tmp'
+
+    return os.path.join(value, '.cache', 'data-for-good', 'semantic_schools', 'wikidata')
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.split())
+
+
+def query_key(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    revalidations: int = 0
+    errors: int = 0
+
+
+@dataclass
+class CacheEntry:
+    """
+    The first line of a cache file.
+    """
+    query: str
+    # when the fetching of the result started, as time.time()
+    created: float
+
+
+@dataclass
+class CachedResult:
+    created: float
+    pages: Iterable[list[dict]]
+
+
+FetchPages = Callable[[str], Iterator[list[dict]]]
+
+
+class WikidataCache:
+    """
+    Use get_wikidata_cache() to get the cache shared by all imports in the
+    current process.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_age: float = DEFAULT_MAX_AGE, max_stale_age: float = DEFAULT_MAX_STALE_AGE):
+        self.cache_dir = cache_dir or os.environ.get('WIKIDATA_CACHE_DIR') or _default_cache_dir()
+        self.max_age = max_age
+        self.max_stale_age = max_stale_age
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._revalidating: dict[str, threading.Thread] = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + _ENTRY_SUFFIX)
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _open(self, key: str) -> tuple[Optional[CacheEntry], Optional[TextIO]]:
+        """
+        Returns the entry and the file positioned at its first page, the
+        pages are read from the same file even if it is replaced meanwhile.
+        """
+        try:
+            f = gzip.open(self._path(key), 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            return None, None
+
+        try:
+            return CacheEntry(**json.loads(f.readline())), f
+        except (OSError, ValueError, TypeError) as e:
+            f.close()
+            logger.warning('Ignoring broken cache entry %s: %s', self._path(key), e)
+            return None, None
+
+    def _read_pages(self, f: TextIO) -> Iterator[list[dict]]:
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def _write_pages(self, key: str, entry: CacheEntry, pages: Iterable[list[dict]]) -> Iterator[list[dict]]:
+        """
+        Writes the pages while they are yielded, the result is cached only
+        when all pages are written.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                f.write(json.dumps(asdict(entry), ensure_ascii=False) + '\n')
+                for page in pages:
+                    f.write(json.dumps(page, ensure_ascii=False) + '\n')
+                    yield page
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _new_entry(self, query: str) -> CacheEntry:
+        return CacheEntry(normalize_query(query), time.time())
+
+    def _fetch(self, key: str, query: str, fetch: FetchPages):
+        for _ in self._write_pages(key, self._new_entry(query), fetch(query)):
+            pass
+
+    def _revalidate(self, key: str, query: str, fetch: FetchPages):
+        def run():
+            try:
+                self._fetch(key, query, fetch)
+                self._count('revalidations')
+            except Exception as e:
+                self._count('errors')
+                logger.warning('Failed to refresh cached result %s: %s', key, e)
+            finally:
+                with self._lock:
+                    self._revalidating.pop(key, None)
+
+        with self._lock:
+            if key in self._revalidating:
+                return
+            thread = self._revalidating[key] = threading.Thread(target=run, name=f'revalidate-{key[:8]}', daemon=True)
+        thread.start()
+
+    def get(self, query: str, fetch: FetchPages, offline: bool = False) -> CachedResult:
+        """
+        Returns the pages of the result of the query from the cache or from
+        fetch(query), check the module documentation. The result holds
+        the time when it was fetched from wikidata.
+
+        When nothing is cached, the pages are returned while they are
+        fetched, so the errors are raised by the iteration over them.
+        """
+        key = query_key(query)
+        entry, f = self._open(key)
+
+        if entry is not None:
+            age = time.time() - entry.created
+            if offline or age <= self.max_age:
+                self._count('hits')
+                return CachedResult(entry.created, self._read_pages(f))
+
+            if age <= self.max_stale_age:
+                self._count('stale_hits')
+                logger.verbose_info('Using cached result %s from %.1f hours ago, refreshing it', key, age / 3600)
+                self._revalidate(key, query, fetch)
+                return CachedResult(entry.created, self._read_pages(f))
+
+        self._count('misses')
+        if offline:
+            raise WikidataCacheMiss(f'The result of the query is not cached (key {key}):\n{query}')
+
+        if entry is None:
+            new_entry = self._new_entry(query)
+            return CachedResult(new_entry.created, self._write_pages(key, new_entry, fetch(query)))
+
+        # the old result is used if the query fails, so the new one is
+        # written in the cache before any of its pages is returned
+        try:
+            self._fetch(key, query, fetch)
+        except Exception as e:
+            self._count('errors')
+            logger.warning('Query failed, using cached result %s from %.1f days ago: %s', key, age / 86400, e)
+            return CachedResult(entry.created, self._read_pages(f))
+
+        f.close()
+        new_entry, new_f = self._open(key)
+        return CachedResult(new_entry.created, self._read_pages(new_f))
+
+    def wait(self):
+        """
+        Waits for the background refreshes of the stale results.
+        """
+        while True:
+            with self._lock:
+                threads = list(self._revalidating.values())
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def log_stats(self):
+        logger.info('Wikidata cache %s: %s', self.cache_dir, asdict(self.stats))
+
+    def export_bundle(self, bundle_file: str) -> int:
+        """
+        Writes all cached results in a tar file. Returns the number of results.
+        """
+        names = []
+        if os.path.isdir(self.cache_dir):
+            names = sorted(n for n in os.listdir(self.cache_dir) if _ENTRY_NAME_RE.match(n))
+
+        with tarfile.open(bundle_file, 'w') as tar:
+            for name in names:
+                tar.add(os.path.join(self.cache_dir, name), arcname=name)
+
+        logger.info('Exported %d cached results from %s to %s', len(names), self.cache_dir, bundle_file)
+        return len(names)
+
+    def import_bundle(self, bundle_file: str) -> int:
+        """
+        Adds the results from a bundle written by export_bundle() to the
+        cache, the existing results with the same keys are replaced.
+        In dry-run mode the bundle is only checked.
+        Returns the number of imported results.
+        """
+        count = 0
+        with tarfile.open(bundle_file, 'r') as tar:
+            for member in tar:
+                if not member.isfile() or not _ENTRY_NAME_RE.match(member.name):
+                    logger.warning('Skipping unexpected bundle member %s', member.name)
+                    continue
+
+                count += 1
+                if is_dry_run():
+                    continue
+
+                os.makedirs(self.cache_dir, exist_ok=True)
+                path = os.path.join(self.cache_dir, member.name)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with tar.extractfile(member) as src, open(tmp_path, 'wb') as dst:
+                    dst.write(src.read())
+                os.replace(tmp_path, path)
+
+        logger.info('Imported %d cached results from %s to %s', count, bundle_file, self.cache_dir)
+        return count
+
+
+_wikidata_cache = None
+
+
+def get_wikidata_cache() -> WikidataCache:
+    """
+    Returns the WikidataCache shared by all imports in the current process.
+    """
+    global _wikidata_cache
+    if _wikidata_cache is None:
+        _wikidata_cache = WikidataCache()
+    return _wikidata_cache
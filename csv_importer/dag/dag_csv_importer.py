@@ -35,6 +35,29 @@ logger = logging.getLogger(__name__)
             type='integer',
             description='Year of the data being imported.'
         ),
+        'chunk_size': Param(
+            default=None,
+            type=['null', 'integer'],
+            description=(
+                'When specified, the CSV file is imported in chunks of that many rows.'
+                ' Use it for big files, the memory usage does not depend on the size of the file.'
+            )
+        ),
+        'force': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True the CSV is imported even if the same file was already imported.'
+        ),
+        'profile': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True the task is profiled, the profiles are written in PROFILE_DIR of the worker or next to its logs.'
+        ),
+        'query_stats': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True summary of the executed SQL statements is logged.'
+        ),
         'dry_run': Param(
             type='boolean',
             default=False,
@@ -73,7 +96,8 @@ def educational_data_import_dzi_csv():
     def import_csv(csv_file, params):
         import os
         from csv_importer.import_csv import import_file
-        from csv_importer.runtime import enable_dry_run, enable_verbose_logging
+        from csv_importer.runtime import enable_dry_run, enable_verbose_logging, enable_profiling, profiled
+        from csv_importer.query_stats import log_query_stats
         from airflow.models import Variable
         import logging
 
@@ -85,16 +109,28 @@ def educational_data_import_dzi_csv():
         db_pass = Variable.get('EDDATA_DB_PASS')
 
         os.environ['DB_URL'] = f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}'
+        if params['query_stats'] == True:
+            os.environ['DB_QUERY_STATS'] = 'yes'
 
         if params['dry_run'] == True:
             logger.info('Will do dry-run execution')
             enable_dry_run()
 
+        if params['profile'] == True:
+            enable_profiling()
+
         enable_verbose_logging()
 
         logger.info(f'Will import file: {csv_file}')
-        import_file(csv_file, 'dzi', 12, params['year'])
-        os.unlink(csv_file)
+        # the timing and memory report is returned as XCom of the task
+        try:
+            with profiled('import_dzi_csv'):
+                report = import_file(csv_file, 'dzi', 12, params['year'], chunk_size=params['chunk_size'], force=params['force'])
+            os.unlink(csv_file)
+        finally:
+            log_query_stats()
+
+        return report
 
     import_csv(download_csv_file())
 
@@ -132,6 +168,29 @@ def educational_data_import_dzi_csv():
             description='Grade of the data being imported.',
             enum=['4', '7', '10'],
         ),
+        'chunk_size': Param(
+            default=None,
+            type=['null', 'integer'],
+            description=(
+                'When specified, the CSV file is imported in chunks of that many rows.'
+                ' Use it for big files, the memory usage does not depend on the size of the file.'
+            )
+        ),
+        'force': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True the CSV is imported even if the same file was already imported.'
+        ),
+        'profile': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True the task is profiled, the profiles are written in PROFILE_DIR of the worker or next to its logs.'
+        ),
+        'query_stats': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True summary of the executed SQL statements is logged.'
+        ),
         'dry_run': Param(
             type='boolean',
             default=False,
@@ -170,7 +229,8 @@ def educational_data_import_nvo_csv():
     def import_csv(csv_file, params):
         import os
         from csv_importer.import_csv import import_file
-        from csv_importer.runtime import enable_dry_run, enable_verbose_logging
+        from csv_importer.runtime import enable_dry_run, enable_verbose_logging, enable_profiling, profiled
+        from csv_importer.query_stats import log_query_stats
         from airflow.models import Variable
         import logging
 
@@ -182,18 +242,30 @@ def educational_data_import_nvo_csv():
         db_pass = Variable.get('EDDATA_DB_PASS')
 
         os.environ['DB_URL'] = f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}'
+        if params['query_stats'] == True:
+            os.environ['DB_QUERY_STATS'] = 'yes'
 
         if params['dry_run'] == True:
             logger.info('Will do dry-run execution')
             enable_dry_run()
 
+        if params['profile'] == True:
+            enable_profiling()
+
         enable_verbose_logging()
 
         grade = int(params['grade'])
 
         logger.info(f'Will import file: {csv_file}')
-        import_file(csv_file, 'nvo', grade, params['year'])
-        os.unlink(csv_file)
+        # the timing and memory report is returned as XCom of the task
+        try:
+            with profiled('import_nvo_csv'):
+                report = import_file(csv_file, 'nvo', grade, params['year'], chunk_size=params['chunk_size'], force=params['force'])
+            os.unlink(csv_file)
+        finally:
+            log_query_stats()
+
+        return report
 
     import_csv(download_csv_file())
 
@@ -214,6 +286,16 @@ def educational_data_import_nvo_csv():
                 ' records matching the specified ids.'
             )
         ),
+        'profile': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True the task is profiled, the profiles are written in PROFILE_DIR of the worker or next to its logs.'
+        ),
+        'query_stats': Param(
+            type='boolean',
+            default=False,
+            description='When this parameter is True summary of the executed SQL statements is logged.'
+        ),
         'dry_run': Param(
             type='boolean',
             default=False,
@@ -233,7 +315,8 @@ def educational_data_delete_examination():
     def delete_examination(params):
         import os
         from csv_importer.db_manage import delete_examination
-        from csv_importer.runtime import enable_dry_run, enable_verbose_logging
+        from csv_importer.runtime import enable_dry_run, enable_verbose_logging, enable_profiling, profiled
+        from csv_importer.query_stats import log_query_stats
         from airflow.models import Variable
         import logging
 
@@ -245,19 +328,28 @@ def educational_data_delete_examination():
         db_pass = Variable.get('EDDATA_DB_PASS')
 
         os.environ['DB_URL'] = f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}'
+        if params['query_stats'] == True:
+            os.environ['DB_QUERY_STATS'] = 'yes'
 
         if params['dry_run'] == True:
             logger.info('Will do dry-run execution')
             enable_dry_run()
 
+        if params['profile'] == True:
+            enable_profiling()
+
         enable_verbose_logging()
 
         examination_ids = params['examination_ids']
         examination_ids = examination_ids.split(',')
-        for examination_id in examination_ids:
-            if examination_id:
-                logger.info(f'Will delete examination: {examination_id}')
-                delete_examination(examination_id)
+        try:
+            for examination_id in examination_ids:
+                if examination_id:
+                    logger.info(f'Will delete examination: {examination_id}')
+                    with profiled(f'delete_examination-{examination_id}'):
+                        delete_examination(examination_id)
+        finally:
+            log_query_stats()
 
     delete_examination()
 